@@ -0,0 +1,520 @@
+""" benchmark gateway3utils on the bundled firmware images """
+import sys
+import os
+import glob
+import io
+import json
+import time
+import asyncio
+import argparse
+import shutil
+import tempfile
+import statistics
+import subprocess
+import threading
+import contextlib
+import tracemalloc
+
+import gateway3utils
+import fake_gateway
+
+BASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _legacy_sum(fwfile):
+    """ the 2-byte read loop used before the word-sum engine """
+    nsum = 0x0
+    with open(fwfile, 'rb') as f_in:
+        while True:
+            byte = f_in.read(2)
+            if not byte:
+                break
+            nsum = nsum + int.from_bytes(byte[0:2], byteorder='big')
+    return nsum & 0xffff
+
+
+def check_sum(files):
+    """ compare calc_words_sum with the 2-byte read loop on files and on
+        random data of odd and even sizes, return False on a mismatch """
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        samples = []
+        for size in (0, 1, 2, 3, 0x10001, gateway3utils.SUM_BLOCK_SIZE + 1):
+            sample = os.path.join(workdir, '{}.bin'.format(size))
+            with open(sample, 'wb') as f_out:
+                f_out.write(os.urandom(size))
+            samples.append(sample)
+        for fwfile in samples + files:
+            # 3 bytes blocks carry an odd byte across every block
+            for block_size in (gateway3utils.SUM_BLOCK_SIZE, 3):
+                if block_size == 3 and os.stat(fwfile).st_size > 0x10001:
+                    continue
+                nsum = gateway3utils.calc_words_sum(fwfile, block_size)[0]
+                if nsum != _legacy_sum(fwfile):
+                    print("Sum mismatch of {} ({} bytes blocks): {}, "
+                          "legacy {}".format(fwfile, block_size, hex(nsum),
+                                             hex(_legacy_sum(fwfile))))
+                    ok = False
+    print("Sums {} the 2-byte read loop.".format(
+        'match' if ok else 'do not match'))
+    return ok
+
+
+def _find_images(dirs):
+    """ list image files under dirs """
+    files = []
+    for path in dirs:
+        files.extend(f for f in glob.glob(os.path.join(path, '**', '*'),
+                                          recursive=True)
+                     if os.path.isfile(f))
+    return sorted(files)
+
+
+def _timeit(func, *args, repeat=3):
+    """ best wall time of func(*args) """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_sum(files, legacy=False, repeat=3):
+    """ MB/s of the word-sum engine """
+    try:
+        import numpy  # noqa pylint: disable=unused-import, import-outside-toplevel
+        engine = 'numpy'
+    except ImportError:
+        engine = 'array'
+    print("engine: {}".format(engine))
+    total_size = 0
+    total_time = 0.0
+    for fwfile in files:
+        fwsize = os.stat(fwfile).st_size
+        elapsed = _timeit(gateway3utils.calc_words_sum, fwfile,
+                          repeat=repeat)
+        total_size = total_size + fwsize
+        total_time = total_time + elapsed
+        line = "{:<48} {:>9} {:>9.1f} MB/s".format(
+            os.path.relpath(fwfile, BASE_PATH), fwsize,
+            fwsize / elapsed / 1e6)
+        if legacy:
+            elapsed = _timeit(_legacy_sum, fwfile, repeat=1)
+            line = "{} (legacy {:.1f} MB/s)".format(
+                line, fwsize / elapsed / 1e6)
+        print(line)
+    if total_time:
+        print("total: {} bytes, {:.1f} MB/s".format(
+            total_size, total_size / total_time / 1e6))
+
+
+def _drain(image):
+    """ read a stream to its end, return the count of bytes """
+    buf = bytearray(gateway3utils.SUM_BLOCK_SIZE)
+    total = 0
+    size = image.readinto(buf)
+    while size:
+        total = total + size
+        size = image.readinto(buf)
+    return total
+
+
+def _db_dump(data, address=0xa1000000):
+    """ DB output lines of the flasher for data """
+    return ["{:08X}: {}    |{}|\r\n".format(
+        address + i, " ".join("{:02x}".format(c) for c in data[i:i+16]),
+        "." * 16).encode() for i in range(0, len(data), 16)]
+
+
+class Suite:
+    """ cases of the offline benchmark, each is run on the images it
+        applies to and returns the count of bytes (records for the
+        cases in RECORD_CASES) it processed, None if it does not apply """
+    RECORD_CASES = ('boot_info',)
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.dumps = {}
+
+    def _cold_sum_cache(self):
+        """ empty sum cache, so sums are calculated and not looked up """
+        path = os.path.join(self.workdir, 'sums.json')
+        with open(path, 'w') as f_out:
+            f_out.write('{}')
+        gateway3utils._sum_cache = gateway3utils.SumCache(path)  # noqa pylint: disable=protected-access
+
+    def _cold_artifact_cache(self):
+        """ empty artifact cache, so the firmware is prepared again """
+        path = os.path.join(self.workdir, 'artifacts')
+        shutil.rmtree(path, ignore_errors=True)
+        gateway3utils._artifact_cache = gateway3utils.ArtifactCache(path)  # noqa pylint: disable=protected-access
+
+    def case_sum(self, fwfile, kind):
+        """ SumCache.lookup, cold cache. calc_sum_of_firmware is not
+            timed, it reads no file whose name has an official sum """
+        self._cold_sum_cache()
+        gateway3utils.get_sum_cache().lookup(fwfile)
+        return os.stat(fwfile).st_size
+
+    def case_checksum(self, fwfile, kind):
+        """ calc_checksum_of_firmware, cold cache """
+        self._cold_sum_cache()
+        gateway3utils.calc_checksum_of_firmware(fwfile)
+        return os.stat(fwfile).st_size
+
+    def case_fw_update(self, fwfile, kind):
+        """ generate_firmware_for_fw_update of raw linux and rootfs """
+        if kind not in ('linux_raw', 'hsqs'):
+            return None
+        link = os.path.join(self.workdir, os.path.basename(fwfile))
+        if not os.path.exists(link):
+            os.symlink(os.path.abspath(fwfile), link)
+        output = gateway3utils.generate_firmware_for_fw_update(
+            link, 'linux_0' if kind == 'linux_raw' else 'rootfs_0')
+        os.remove(output)
+        return os.stat(fwfile).st_size
+
+    def case_sections(self, fwfile, kind):
+        """ _extract_firmwares and reading every section """
+        if kind != 'miot':
+            return None
+        bundle = gateway3utils._extract_firmwares(fwfile)  # noqa pylint: disable=protected-access
+        return sum(len(bundle.section_data(name))
+                   for name in bundle.sections)
+
+    def case_padded(self, fwfile, kind):
+        """ _padded_firmware of the burns and reading the padded stream,
+            cold caches """
+        if kind not in ('cr6c', 'r6cr', 'linux_raw', 'hsqs'):
+            return None
+        self._cold_sum_cache()
+        self._cold_artifact_cache()
+        params = {'fwfile': fwfile, 'fwdata': None}
+        image = gateway3utils._padded_firmware(  # noqa pylint: disable=protected-access
+            params, gateway3utils._read_firmware(params))  # noqa pylint: disable=protected-access
+        return None if image is None else _drain(image)
+
+    def case_boot_info(self, fwfile, kind):
+        """ calc_checksum_boot_info of boot_info.yaml, 200 times """
+        if kind != 'boot_info':
+            return None
+        for _ in range(200):
+            gateway3utils.calc_checksum_boot_info(fwfile)
+        return 200
+
+    def case_db_parser(self, fwfile, kind):
+        """ parse_db_line of a DB dump of the first 1MB, the dump is
+            made by the first call """
+        if kind not in ('linux_raw', 'cr6c'):
+            return None
+        if fwfile not in self.dumps:
+            with open(fwfile, 'rb') as f_in:
+                self.dumps[fwfile] = _db_dump(f_in.read(0x100000))
+        buf = bytearray()
+        for line in self.dumps[fwfile]:
+            buf.extend(gateway3utils.parse_db_line(line)[1])
+        return len(buf)
+
+    def cases(self):
+        """ (name, method) of all cases """
+        return [(name[5:], getattr(self, name)) for name in sorted(dir(self))
+                if name.startswith('case_')]
+
+
+def _peak_memory(func, *args):
+    """ peak of traced memory allocated by func(*args) """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _synthetic_miot(path, files):
+    """ write a MIOT all-in-one firmware of the first gbl, cr6c and r6cr
+        images of files to path, random data stands in for a missing one """
+    images = {}
+    for fwfile in files:
+        images.setdefault(_kind_of(fwfile), fwfile)
+    with open(path, 'wb') as f_out:
+        f_out.write(b'MIOT' + bytes(gateway3utils.MIOT_HEADER_LENGTH - 4))
+        for name, magic in gateway3utils.MIOT_SECTIONS:
+            kind = {'linux': 'cr6c', 'rootfs': 'r6cr'}.get(name, 'gbl')
+            if name != 'ota' and kind in images:
+                with open(images[kind], 'rb') as f_in:
+                    data = f_in.read()
+            else:
+                data = (magic or b'OTA\0') + os.urandom(0x10000 - 4)
+            f_out.write((len(data) + gateway3utils.MIOT_SECTION_HEADER_LENGTH)
+                        .to_bytes(4, byteorder='big') + bytes(4) +
+                        (1).to_bytes(2, byteorder='big'))
+            f_out.write(data)
+
+
+def run_suite(files, repeat=3):
+    """ {case: {'amount', 'unit', 'seconds', 'rate', 'peak'}} over files,
+        rate is the amount per second """
+    results = {}
+    inputs = [(fwfile, _kind_of(fwfile)) for fwfile in files]
+    inputs.append((os.path.join(BASE_PATH, 'scripts', 'boot_info.yaml'),
+                   'boot_info'))
+    with tempfile.TemporaryDirectory() as workdir, \
+            contextlib.redirect_stdout(io.StringIO()):
+        if 'miot' not in [kind for _, kind in inputs]:
+            # the repository has no MIOT firmware, section parsing runs
+            # on one made of the other images
+            miot = os.path.join(workdir, 'all_synthetic.bin')
+            _synthetic_miot(miot, files)
+            inputs.append((miot, 'miot'))
+        suite = Suite(workdir)
+        for name, case in suite.cases():
+            total_size = 0
+            total_time = 0.0
+            largest = (0, None, None)
+            for fwfile, kind in inputs:
+                # the first call is a warm-up and finds the size
+                size = case(fwfile, kind)
+                if size is None:
+                    continue
+                total_size = total_size + size
+                total_time = total_time + _timeit(case, fwfile, kind,
+                                                  repeat=repeat)
+                largest = max(largest, (size, fwfile, kind))
+            if total_time:
+                # tracing is slow, only the largest input is traced
+                peak = _peak_memory(case, *largest[1:])
+                results[name] = {
+                    'amount': total_size,
+                    'unit': 'records' if name in Suite.RECORD_CASES
+                            else 'bytes',
+                    'seconds': total_time,
+                    'rate': total_size / total_time,
+                    'peak': peak}
+    gateway3utils._sum_cache = None  # pylint: disable=protected-access
+    return results
+
+
+def _kind_of(fwfile):
+    """ detect_firmware_kind of fwfile """
+    with open(fwfile, 'rb') as f_in:
+        return gateway3utils.detect_firmware_kind(f_in.read(64))
+
+
+def compare_baseline(results, baseline, threshold):
+    """ list of regressions of results against baseline, a result is
+        regressed if its throughput is lower or its peak memory higher
+        than the baseline by more than threshold """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['rate'] < base['rate'] * (1 - threshold):
+            regressions.append("{}: {}, baseline {}".format(
+                name, _format_rate(result['rate'], result['unit']),
+                _format_rate(base['rate'], result['unit'])))
+        if result['peak'] > base['peak'] * (1 + threshold) + 65536:
+            regressions.append("{}: peak {} bytes, baseline {}".format(
+                name, result['peak'], base['peak']))
+    return regressions
+
+
+def _format_rate(rate, unit):
+    """ MB/s of bytes, records/s of records """
+    if unit == 'bytes':
+        return "{:.1f} MB/s".format(rate / 1e6)
+    return "{:.0f} {}/s".format(rate, unit)
+
+
+def bench_suite(files, repeat=3, baseline=None, save=None, threshold=.2):
+    """ run the suite, return False if it regressed against baseline """
+    results = run_suite(files, repeat)
+    print("{:<12} {:>18} {:>16} {:>12}".format(
+        'case', 'amount', 'rate', 'peak bytes'))
+    for name, result in sorted(results.items()):
+        print("{:<12} {:>18} {:>16} {:>12}".format(
+            name, "{} {}".format(result['amount'], result['unit']),
+            _format_rate(result['rate'], result['unit']), result['peak']))
+    if save:
+        with open(save, 'w') as f_out:
+            json.dump(results, f_out, indent=2, sort_keys=True)
+        print("Saved baseline {}".format(save))
+    if baseline:
+        with open(baseline, 'r') as f_in:
+            regressions = compare_baseline(results, json.load(f_in),
+                                           threshold)
+        for line in regressions:
+            print("Regression {}".format(line))
+        if regressions:
+            return False
+        print("No regression over {:.0%} against {}".format(
+            threshold, baseline))
+    return True
+
+
+def _start_fake_gateway(gateway):
+    """ serve gateway on an ephemeral port of 127.0.0.1 in a thread,
+        return the port """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(
+        gateway.handle, '127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return server.sockets[0].getsockname()[1]
+
+
+def bench_telnet(fwfile, fwtype, rate):
+    """ time-to-flash of raw and gzip delivery to a fake gateway
+        whose wget downloads at rate bytes/s, the first gzip run
+        includes the compression and the second one uses the cache """
+    print("wget rate: {} bytes/s".format(rate))
+    results = []
+    for name, compressed in (('raw', False), ('gzip', True),
+                             ('gzip cached', True)):
+        gateway = fake_gateway.FakeGateway('bench', rate=rate)
+        port = _start_fake_gateway(gateway)
+        params = {'ipaddr': '127.0.0.1:{}'.format(port), 'fwtype': fwtype,
+                  'fwfile': fwfile, 'gzip': compressed, 'verify': True}
+        start = time.perf_counter()
+        done = gateway3utils.burn_via_telnet(params)
+        results.append((name, time.perf_counter() - start, done))
+    for name, elapsed, done in results:
+        print("{:<12} {:>7.1f}s {}".format(
+            name, elapsed, 'ok' if done else 'failed'))
+
+
+# the quick commands must not load the modules of the serial/telnet burns
+STARTUP_COMMANDS = (
+    ('help', ['-h']),
+    ('sum', ['-s', '-f', '{image}']),
+    ('checksum', ['-u', '-f', '{image}']),
+    ('password', ['-e', '123456789', '-m', '54:EF:44:00:00:01',
+                  '-k', '0123456789abcdef']),
+    ('cmdline', ['-l', 'console=ttyS0,38400']),
+)
+HEAVY_MODULES = ('serial', 'xmodem', 'pyprind', 'numpy', 'yaml', 'tkinter',
+                 'telnetlib', 'http.server', 'asyncio', 'concurrent.futures')
+# seconds a quick command may take to start
+STARTUP_BUDGET = .15
+
+
+def _imported_modules(args, env):
+    """ names of the modules imported by a run, by python -X importtime """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        check=False).stderr.decode(errors='replace')
+    return {line.split('|')[-1].strip() for line in output.splitlines()
+            if line.startswith('import time:')}
+
+
+def _startup_time(args, env, repeat):
+    """ median wall time of runs of python with args """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=False)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_startup(budget=STARTUP_BUDGET, repeat=10):
+    """ wall time of the quick commands of gateway3utils, False if one
+        exceeds budget seconds or loads one of the HEAVY_MODULES """
+    script = os.path.abspath(gateway3utils.__file__)
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, GATEWAY3_CACHE_DIR=workdir)
+        image = os.path.join(workdir, 'image.bin')
+        with open(image, 'wb') as f_out:
+            f_out.write(os.urandom(0x10000))
+        python = _startup_time(['-c', 'pass'], env, repeat)
+        print("{:<10} {:>8} {:>8}  {}".format('command', 'ms', 'python',
+                                             'heavy modules'))
+        print("{:<10} {:>8.1f}".format('python', python * 1e3))
+        for name, args in STARTUP_COMMANDS:
+            args = ['-W', 'ignore', script] + [arg.format(image=image)
+                                               for arg in args]
+            elapsed = _startup_time(args, env, repeat)
+            heavy = sorted(set(HEAVY_MODULES) & _imported_modules(args, env))
+            print("{:<10} {:>8.1f} {:>+8.1f}  {}".format(
+                name, elapsed * 1e3, (elapsed - python) * 1e3,
+                ' '.join(heavy) or '-'))
+            if heavy or elapsed > budget:
+                ok = False
+    if not ok:
+        print("Startup over the budget of {:.0f} ms or loading heavy "
+              "modules!".format(budget * 1e3))
+    return ok
+
+
+def main():
+    """ benchmark entry """
+    parser = argparse.ArgumentParser(description='Gateway 3 Utils benchmark')
+    parser.add_argument('dirs', nargs='*',
+                        help='directories of firmware images, default is '
+                        'original/ and also raw/ for --suite')
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the old 2-byte read loop')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the sums with the 2-byte read loop')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='repeat count, the best time is kept')
+    parser.add_argument('--suite', action='store_true',
+                        help='time all the processing of the utils and '
+                        'their peak memory')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='fail if --suite regresses against JSON')
+    parser.add_argument('--save', metavar='JSON',
+                        help='save the --suite results as a baseline')
+    parser.add_argument('--threshold', type=float, default=.2,
+                        help='allowed regression, default 0.2 (20%%)')
+    parser.add_argument('--telnet', metavar='FILE',
+                        help='time raw and gzip telnet burns of FILE to a '
+                        'fake gateway instead')
+    parser.add_argument('-t', '--fwtype', default='linux_0',
+                        help='firmware type of --telnet')
+    parser.add_argument('--rate', type=int, default=1000000,
+                        help='wget speed of the fake gateway in bytes/s')
+    parser.add_argument('--startup', action='store_true',
+                        help='time the start of the quick commands instead')
+    parser.add_argument('--budget', type=float,
+                        default=STARTUP_BUDGET * 1e3,
+                        help='startup budget of --startup in ms')
+    args = parser.parse_args()
+
+    if args.startup:
+        if not bench_startup(args.budget / 1e3, max(args.repeat, 10)):
+            sys.exit(1)
+        return
+
+    if args.telnet:
+        bench_telnet(args.telnet, args.fwtype, args.rate)
+        return
+
+    dirs = args.dirs or [os.path.join(BASE_PATH, 'original')] + (
+        [os.path.join(BASE_PATH, 'raw')] if args.suite else [])
+    files = _find_images(dirs)
+    if not files:
+        print("No firmware images found!")
+        return
+    if args.check:
+        if not check_sum(files):
+            sys.exit(1)
+        return
+    if args.suite:
+        if not bench_suite(files, args.repeat, args.baseline, args.save,
+                           args.threshold):
+            sys.exit(1)
+        return
+    bench_sum(files, legacy=args.legacy, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+""" fake bootrom and flasher of gateway 3 on a pseudo-terminal for testing
+    the serial modes without hardware """
+import os
+import re
+import sys
+import pty
+import tty
+import time
+import random
+import select
+import signal
+import termios
+import argparse
+import threading
+
+import gateway3utils
+
+SOH = 0x01
+STX = 0x02
+EOT = 0x04
+ACK = 0x06
+NAK = 0x15
+CAN = 0x18
+CRC = b'C'
+PROMPT = b'\r\n<RealTek>'
+PAGE_SIZE = 0x10000
+
+
+def crc16(data):
+    """ CRC-16/XMODEM """
+    crc = 0
+    for byte in data:
+        crc = crc ^ byte << 8
+        for _ in range(8):
+            crc = (crc << 1 ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xffff
+    return crc
+
+
+class SparseMemory:
+    """ memory of fill bytes, only the written pages are allocated """
+
+    def __init__(self, fill=0xff):
+        self.fill = fill
+        self.pages = {}
+
+    def read(self, address, size):
+        """ size bytes at address """
+        data = bytearray()
+        while size > 0:
+            page, offset = divmod(address, PAGE_SIZE)
+            length = min(size, PAGE_SIZE - offset)
+            if page in self.pages:
+                data.extend(self.pages[page][offset:offset + length])
+            else:
+                data.extend(bytes([self.fill]) * length)
+            address = address + length
+            size = size - length
+        return bytes(data)
+
+    def write(self, address, data):
+        """ write data at address """
+        data = memoryview(data)
+        while data:
+            page, offset = divmod(address, PAGE_SIZE)
+            length = min(len(data), PAGE_SIZE - offset)
+            if page not in self.pages:
+                self.pages[page] = bytearray([self.fill]) * PAGE_SIZE
+            self.pages[page][offset:offset + length] = data[:length]
+            address = address + length
+            data = data[length:]
+
+
+def _int(text):
+    """ int of a 0x prefixed or decimal number """
+    return int(text, 0) if text.lower().startswith('0x') else int(text)
+
+
+class FakeBootrom:
+    """ bootrom of the RTL8197F in a gateway 3 and the flasher it runs
+
+        Output and input are throttled to the baud rate, every command
+        answers after latency seconds and programming takes
+        program_time seconds per erase block. noise is the probability
+        that an XMODEM packet is received corrupted, program_errors the
+        probability that a NANDW fails. If strict is set,
+        the flasher drops what is sent at another rate than its own. """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, fd, baudrate=38400, flasher_baudrate=230400,
+                 latency=0.0, program_time=0.0, noise=0.0, echo=True,
+                 strict=False, program_errors=0.0):
+        self.fd = fd
+        self.baudrate = baudrate
+        self.rom_baudrate = baudrate
+        self.flasher_baudrate = flasher_baudrate
+        self.latency = latency
+        self.program_time = program_time
+        self.noise = noise
+        self.echo = echo
+        self.strict = strict
+        self.program_errors = program_errors
+        self.nand = SparseMemory(0xff)
+        self.ddr = SparseMemory(0x00)
+        self.state = 'boot'
+        self.buf = bytearray()
+        self.stats = {'commands': 0, 'programmed': 0, 'naks': 0}
+        self.nand.write(gateway3utils.BOOT_INFO_OFFSET,
+                        gateway3utils.BootInfo.default().pack())
+
+    def _garbled(self):
+        """ True if strict and the host port is not at the rate of the
+            flasher, then neither side understands the other """
+        return (self.strict and self.state == 'flasher' and
+                termios.tcgetattr(self.fd)[4] != getattr(
+                    termios, 'B{}'.format(self.flasher_baudrate), None))
+
+    def _write(self, data):
+        """ write to the host at the baud rate """
+        if self._garbled():
+            return
+        if self.baudrate:
+            time.sleep(len(data) * 10 / self.baudrate)
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def _fill(self, timeout):
+        """ read from the host into buf, False on timeout """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError:
+            raise EOFError()
+        if not data:
+            raise EOFError()
+        if self.baudrate:
+            time.sleep(len(data) * 10 / self.baudrate)
+        if self.strict and not data.strip(b'u'):
+            # only a repowered gateway answers the break-in
+            self.state = 'rom'
+        if self._garbled():
+            return True
+        self.buf.extend(data)
+        return True
+
+    def _read(self, size, timeout):
+        """ size bytes or less on timeout """
+        deadline = time.monotonic() + timeout
+        while len(self.buf) < size:
+            if not self._fill(max(0, deadline - time.monotonic())):
+                break
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def _readline(self):
+        """ a command line, echoed like the console does """
+        while b'\n' not in self.buf and b'\r' not in self.buf:
+            if self.buf.endswith(b'uuu'):
+                # the break-in of a repowered gateway, the bytes before it
+                # are left from an interrupted session
+                self.buf.clear()
+                return 'uuu'
+            self._fill(None)
+        match = re.search(rb'[\r\n]', self.buf)
+        line = bytes(self.buf[:match.start()])
+        del self.buf[:match.end()]
+        if self.echo:
+            self._write(line + b'\r\n')
+        return line.decode(errors='replace').strip()
+
+    def xmodem_receive(self, address):
+        """ receive by XMODEM-CRC into DDR at address,
+            return the size or None """
+        data = bytearray()
+        expected = 1
+        breaks = 0
+        for _ in range(60):
+            self._write(CRC)
+            if self._fill(.5):
+                break
+        else:
+            return None
+        while True:
+            head = self._read(1, 10)
+            if not head or head[0] == CAN:
+                return None
+            if head[0] == EOT:
+                self._write(bytes([ACK]))
+                break
+            breaks = breaks + 1 if head == b'u' else 0
+            if breaks == 3:
+                # the break-in of a repowered gateway
+                self.buf[:0] = b'uuu'
+                return None
+            if head[0] not in (SOH, STX):
+                continue
+            size = 128 if head[0] == SOH else 1024
+            packet = self._read(size + 4, 2)
+            if len(packet) < size + 4:
+                self._write(bytes([NAK]))
+                continue
+            payload = packet[2:2 + size]
+            if self.noise and random.random() < self.noise:
+                payload = bytes([payload[0] ^ 0xff]) + payload[1:]
+            if (packet[0] + packet[1] != 0xff or
+                    crc16(payload) != int.from_bytes(packet[-2:], 'big')):
+                self.stats['naks'] = self.stats['naks'] + 1
+                self._write(bytes([NAK]))
+                continue
+            if packet[0] == expected & 0xff:
+                data.extend(payload)
+                expected = expected + 1
+            self._write(bytes([ACK]))
+        self.ddr.write(address, data)
+        return len(data)
+
+    def _confirm(self):
+        """ wait for the y of a flash command """
+        self._write(b'Are you sure? (Y/N)')
+        return self._readline().lower() == 'y'
+
+    def _nand_program(self, offset, data):
+        blocks = -(-len(data) // gateway3utils.ERASE_BLOCK_SIZE)
+        time.sleep(self.program_time * blocks)
+        self.nand.write(offset, data)
+        self.stats['programmed'] = self.stats['programmed'] + len(data)
+
+    def _dump(self, address, size):
+        """ DB output """
+        data = self.ddr.read(address, size)
+        lines = [b' [Addr]   .0 .1 .2 .3 .4 .5 .6 .7 .8 .9 .A .B .C .D .E .F']
+        for i in range(0, len(data), 16):
+            row = data[i:i + 16]
+            lines.append('{:08X}: {}    |{}|'.format(
+                address + i, ' '.join('{:02x}'.format(c) for c in row),
+                ''.join(chr(c) if 32 <= c < 127 else '.'
+                        for c in row)).encode())
+        return b'\r\n'.join(lines)
+
+    def _boot_ctrl(self, args):
+        """ boot_ctrl set_kernel0 SIZE SUM, set_rootfs_newest SLOT """
+        offset = gateway3utils.BOOT_INFO_OFFSET
+        info = gateway3utils.BootInfo.unpack(
+            self.nand.read(offset, gateway3utils.BOOT_INFO_SIZE))
+        match = re.match(r'set_(kernel|linux|rootfs)_?newest$', args[0])
+        if match:
+            name = 'rootfs' if match.group(1) == 'rootfs' else 'kernel'
+            info = info._replace(**{name + '_newest': _int(args[1])})
+        else:
+            match = re.match(r'set_(kernel|rootfs)([01])$', args[0])
+            if match is None:
+                return b'boot_ctrl: unknown command'
+            name = match.group(1) + match.group(2)
+            info = info._replace(**{name + '_size': _int(args[1]),
+                                    name + '_checksum': int(args[2], 16)})
+        self._nand_program(offset, info.seal().pack())
+        return b''
+
+    def command(self, line):
+        """ run a console command, return the output without prompt """
+        # pylint: disable=too-many-return-statements
+        args = line.split()
+        if not args:
+            return b''
+        self.stats['commands'] = self.stats['commands'] + 1
+        name = args[0].lower()
+        if name in ('xmrx', 'xmod'):
+            size = self.xmodem_receive(_int(args[1]))
+            if size is None:
+                return b'Rx timeout'
+            return 'Rx len={}'.format(hex(size)).encode()
+        if name == 'j':
+            self.state = 'flasher'
+            if self.baudrate:
+                self.baudrate = self.flasher_baudrate
+            return 'Jump to {}'.format(args[1]).encode()
+        if not name.strip('u'):
+            # break-in of a new session, as if the gateway was repowered
+            self.state = 'rom'
+            if self.baudrate:
+                self.baudrate = self.rom_baudrate
+            return b'Enter ROM console'
+        if name == 'eb':
+            self.ddr.write(_int(args[1]),
+                           bytes(int(value, 16) for value in args[2:]))
+            return b''
+        if name == 'db':
+            return self._dump(_int(args[1]), _int(args[2]))
+        if name == 'nandw':
+            if not self._confirm():
+                return b'Abort'
+            if self.program_errors and random.random() < self.program_errors:
+                return b'Program NAND flash fail'
+            self._nand_program(_int(args[1]),
+                               self.ddr.read(_int(args[2]), _int(args[3])))
+            return b'Program NAND flash done'
+        if name == 'nandr':
+            if not self._confirm():
+                return b'Abort'
+            self.ddr.write(_int(args[2]),
+                           self.nand.read(_int(args[1]), _int(args[3])))
+            return b'Read NAND flash done'
+        if name == 'boot_ctrl':
+            return self._boot_ctrl(args[1:])
+        if name in ('dbgmsg', 'ri'):
+            return b''
+        return 'Unknown command: {}'.format(args[0]).encode()
+
+    def run(self):
+        """ serve until the host closes the pty """
+        try:
+            while self.state == 'boot':
+                self._fill(None)
+                if b'u' in self.buf:
+                    self.buf.clear()
+                    self.state = 'rom'
+                    self._write(b'\r\nEnter ROM console' + PROMPT)
+            while True:
+                line = self._readline()
+                if self.latency:
+                    time.sleep(self.latency)
+                output = self.command(line)
+                self._write((output + PROMPT) if output else PROMPT)
+        except EOFError:
+            pass
+
+    def partition(self, fwtype):
+        """ bytes of a partition of the NAND """
+        return self.nand.read(int(gateway3utils.firmware_info[fwtype], 0),
+                              gateway3utils._partition_size(fwtype))  # noqa pylint: disable=protected-access
+
+
+def main():
+    """ fake bootrom entry """
+    parser = argparse.ArgumentParser(
+        description='Fake bootrom of gateway 3 on a pseudo-terminal')
+    parser.add_argument('--baudrate', type=int, default=38400,
+                        help='throttle of the bootrom, 0 is not throttled')
+    parser.add_argument('--flasher-baudrate', type=int, default=230400,
+                        help='throttle of the flasher')
+    parser.add_argument('--strict', action='store_true',
+                        help='the flasher ignores the host unless the port '
+                        'is set to --flasher-baudrate')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each command answers')
+    parser.add_argument('--program-time', type=float, default=0.0,
+                        help='seconds to program an erase block')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='probability of a corrupted XMODEM packet')
+    parser.add_argument('--program-errors', type=float, default=0.0,
+                        help='probability of a failed NANDW')
+    parser.add_argument('--load', nargs='+', default=[],
+                        metavar='PART=FILE',
+                        help='preload partitions, e.g. linux_0=linux.bin')
+    parser.add_argument('--dump', metavar='DIR',
+                        help='write the programmed partitions to DIR at exit')
+    parser.add_argument('--count', type=int, default=1,
+                        help='count of gateways, each on its own '
+                        'pseudo-terminal, for the station mode')
+    args = parser.parse_args()
+
+    bootroms = []
+    for _ in range(args.count):
+        master, slave = pty.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        bootrom = FakeBootrom(master, args.baudrate, args.flasher_baudrate,
+                              args.latency, args.program_time, args.noise,
+                              strict=args.strict,
+                              program_errors=args.program_errors)
+        for item in args.load:
+            fwtype, fwfile = item.split('=', 1)
+            with open(fwfile, 'rb') as f_in:
+                bootrom.nand.write(
+                    int(gateway3utils.firmware_info[fwtype], 0), f_in.read())
+        print("Fake gateway on {}".format(os.ttyname(slave)))
+        bootroms.append((os.ttyname(slave), bootrom))
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    threads = [threading.Thread(target=bootrom.run, daemon=True)
+               for _, bootrom in bootroms]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(.5)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    for index, (name, bootrom) in enumerate(bootroms):
+        print("{}: {commands} commands, {programmed} bytes programmed, "
+              "{naks} NAKs".format(name, **bootrom.stats))
+        if not args.dump:
+            continue
+        path = args.dump if args.count == 1 else os.path.join(
+            args.dump, str(index))
+        os.makedirs(path, exist_ok=True)
+        for fwtype in gateway3utils.MTD_PARTITIONS:
+            data = bootrom.partition(fwtype)
+            if data.count(0xff) != len(data):
+                with open(os.path.join(path, fwtype + '.bin'),
+                          'wb') as f_out:
+                    f_out.write(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+""" fake telnet gateway 3 for testing the telnet/fleet mode without hardware """
+import sys
+import time
+import shlex
+import hashlib
+import gzip
+import asyncio
+import argparse
+import urllib.request
+
+BOOT_INFO_SHOW = (
+    "vernum: 0\n"
+    "bversion: 1.0.2.005\n"
+    "kernel: {kernel} {kernel}\n"
+    "rootfs: {rootfs} {rootfs}\n"
+    "kernel_0: 0 cb43 2157572\n"
+    "kernel_1: 0 c8cf 2157572\n"
+    "rootfs_0: 0 742c 10108932\n"
+    "rootfs_1: 0 84df 8781828\n"
+    "root_sum_check: off\n"
+    "priv_mode: on\n")
+
+# /dev/mtdN of linux_0, rootfs_0, linux_1 and rootfs_1
+MTD_DEVICES = {'kernel0': '/dev/mtd5', 'rootfs0': '/dev/mtd6',
+               'kernel1': '/dev/mtd7', 'rootfs1': '/dev/mtd8'}
+
+
+class FakeGateway:
+    """ busybox shell of a gateway 3 behind telnetd """
+
+    def __init__(self, name, latency=0.0, rate=0, fail=False,
+                 corrupt=False):
+        self.name = name
+        self.latency = latency
+        self.rate = rate
+        self.fail = fail
+        self.corrupt = corrupt
+        self.files = {}
+        self.mtd = {}
+        self.kernel = 0
+        self.rootfs = 0
+        # exit status of the last command, for echo $?
+        self.status = 0
+
+    def _download(self, url):
+        """ fetch url, throttled to rate bytes/s """
+        start = time.monotonic()
+        data = bytearray()
+        with urllib.request.urlopen(url, timeout=30) as f_in:
+            while True:
+                chunk = f_in.read(16384)
+                if not chunk:
+                    break
+                data.extend(chunk)
+                if self.rate:
+                    delay = len(data) / self.rate - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+        return bytes(data)
+
+    def _read(self, path):
+        """ data of a file or an mtd device, None if it does not exist """
+        return self.files.get(path, self.mtd.get(path))
+
+    def wget(self, args):
+        """ wget URL -O FILE, the data is the output with -O - """
+        url = [arg for arg in args if arg.startswith('http')][0]
+        path = args[args.index('-O') + 1]
+        try:
+            data = self._download(url)
+        except OSError as err:
+            return "wget: {}\n".format(err).encode()
+        if path == '-':
+            return data
+        self.files[path] = data
+        return "Connecting to {}\nsaved {} bytes\n".format(
+            url, len(data)).encode()
+
+    def fw_update(self, args):
+        """ fw_update FILE """
+        data = self.files.get(args[0])
+        if data is None:
+            return "fw_update: {}: No such file\n".format(args[0])
+        if self.fail or data[:4] not in (b'cr6c', b'r6cr'):
+            return "fw_update: invalid image\nFailed\n"
+        length = int.from_bytes(data[12:16], byteorder='big')
+        if length < len(data) - 16:
+            return "fw_update: bad length\nFailed\n"
+        image = bytearray(data[16:])
+        if self.corrupt and image:
+            image[len(image) // 2] ^= 0xff
+        if data[:4] == b'cr6c':
+            self.kernel = 1 - self.kernel
+            self.mtd[MTD_DEVICES['kernel{}'.format(self.kernel)]] = image
+        else:
+            self.rootfs = 1 - self.rootfs
+            self.mtd[MTD_DEVICES['rootfs{}'.format(self.rootfs)]] = image
+        return "fw_update: writing {} bytes\nSuccess\n".format(len(data))
+
+    def command(self, args, stdin):
+        """ run one command of a pipeline, return its output bytes """
+        # pylint: disable=too-many-return-statements
+        name = args[0]
+        if name == 'echo':
+            return "{}\n".format(' '.join(args[1:]).replace(
+                '$?', str(self.status))).encode()
+        self.status = 0
+        if name == 'run_ble_dfu.sh':
+            # run_ble_dfu.sh TTY FILE VERSION 1, FILE is in /tmp
+            if self.fail or '/tmp/{}'.format(args[2]) not in self.files:
+                self.status = 1
+            return b""
+        data = self._read(args[-1]) if len(args) > 1 else stdin
+        if name == 'boot_ctrl' and args[1:] == ['show']:
+            return BOOT_INFO_SHOW.format(kernel=self.kernel,
+                                         rootfs=self.rootfs).encode()
+        if name == 'wget':
+            return self.wget(args[1:])
+        if name == 'fw_update':
+            return self.fw_update(args[1:]).encode()
+        if name == 'rm':
+            for path in args[1:]:
+                self.files.pop(path, None)
+            return b""
+        if name == 'gunzip':
+            try:
+                return gzip.decompress(stdin)
+            except (OSError, EOFError):
+                return b"gunzip: invalid data\n"
+        if name not in ('head', 'md5sum', 'wc'):
+            self.status = 127
+            return "sh: {}: not found\n".format(name).encode()
+        if data is None:
+            return "{}: {}: No such file or directory\n".format(
+                name, args[-1]).encode()
+        if name == 'head':
+            return bytes(data[:int(args[2])])
+        if name == 'md5sum':
+            return "{}  {}\n".format(hashlib.md5(data).hexdigest(),
+                                     args[1] if len(args) > 1 else '-'
+                                     ).encode()
+        return "{} {}\n".format(len(data), args[-1] if len(args) > 2
+                                else '').encode()
+
+    def run(self, line):
+        """ run a shell command line of pipelines separated by ;
+            with an optional > FILE, return the output """
+        output = b""
+        for commands in line.split(';'):
+            path = None
+            if '>' in commands:
+                commands, path = commands.split('>', 1)
+                path = path.strip()
+            data = b""
+            try:
+                for command in commands.split('|'):
+                    args = shlex.split(command)
+                    if args:
+                        data = self.command(args, data)
+            except (ValueError, IndexError):
+                return "sh: syntax error\n"
+            if path:
+                self.files[path] = data
+            else:
+                output = output + data
+        return output.decode(errors='replace')
+
+    async def handle(self, reader, writer):
+        """ one telnet session """
+        loop = asyncio.get_event_loop()
+        logged_in = False
+        writer.write(b"\r\nrlxlinux login: ")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode(errors='replace').strip()
+            if not logged_in:
+                if line == 'admin':
+                    logged_in = True
+                    writer.write(b"\n# ")
+                else:
+                    writer.write(b"\r\nrlxlinux login: ")
+                continue
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            output = await loop.run_in_executor(None, self.run, line)
+            writer.write("{}\n# ".format(output).encode())
+            await writer.drain()
+        writer.close()
+
+
+async def serve(gateways, host, port):
+    """ serve gateways on port, port + 1, ... """
+    servers = []
+    for index, gateway in enumerate(gateways):
+        servers.append(await asyncio.start_server(
+            gateway.handle, host, port + index))
+        print("{} on {}:{}".format(gateway.name, host, port + index))
+    sys.stdout.flush()
+    await asyncio.gather(*[server.serve_forever() for server in servers])
+
+
+def main():
+    """ fake gateway entry """
+    parser = argparse.ArgumentParser(description='Fake telnet gateway 3')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2323,
+                        help='port of the first gateway')
+    parser.add_argument('--count', type=int, default=1,
+                        help='count of gateways')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before each command answers')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='download speed of wget in bytes/s')
+    parser.add_argument('--fail', type=int, default=0,
+                        help='count of gateways whose fw_update fails')
+    parser.add_argument('--corrupt', type=int, default=0,
+                        help='count of gateways which flash a flipped byte')
+    args = parser.parse_args()
+
+    gateways = [FakeGateway('gateway{}'.format(i), args.latency, args.rate,
+                            i < args.fail, i < args.corrupt)
+                for i in range(args.count)]
+    try:
+        asyncio.run(serve(gateways, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -11,29 +11,62 @@ import hmac
 import base64
 import re
 import socket
+import array
+import mmap
+import tempfile
+import collections
+import json
+import io
+import select
+import struct
+import glob
+import csv
+import gzip
+import functools
+import contextlib
+
+# the modules of the serial and telnet burns are imported by the commands
+# which need them, so the quick commands start without loading them. The
+# imports are plain import statements for PyInstaller to find.
+
+
+def _import_serial_modules():
+    """ import pyserial, xmodem and pyprind into the globals, a missing
+        module is skipped so that the checks of sys.modules report it """
+    # pylint: disable=global-statement, import-outside-toplevel
+    # pylint: disable=redefined-outer-name, invalid-name
+    global serial, list_ports, XMODEM, XMODEM1k, pyprind
+    try:
+        import serial
+        from serial.tools import list_ports
+    except ImportError:
+        pass
+    try:
+        from xmodem import XMODEM, XMODEM1k
+    except ImportError:
+        pass
+    try:
+        import pyprind
+    except ImportError:
+        pass
+
+
+def _import_telnet_modules():
+    """ import telnetlib, http.server and concurrent.futures into the
+        globals, a missing module is skipped like above """
+    # pylint: disable=global-statement, import-outside-toplevel
+    # pylint: disable=redefined-outer-name, invalid-name
+    global Telnet, http, concurrent
+    try:
+        from telnetlib import Telnet
+    except ImportError:
+        pass
+    try:
+        import http.server
+    except ImportError:
+        pass
+    import concurrent.futures
 
-try:
-    import tkinter
-    import serial
-    from serial.tools import list_ports
-    from xmodem import XMODEM, XMODEM1k
-except ImportError:
-    pass
-try:
-    from telnetlib import Telnet
-    import http.server
-    import socketserver
-except ImportError:
-    pass
-import yaml
-try:
-    import tftpy
-except ImportError:
-    pass
-try:
-    import pyprind
-except ImportError:
-    pass
 
 firmware_info = {
     "bootloader": "0x00000000",
@@ -68,197 +101,668 @@ def convert_cmdline(cmdline):
         print("eb {} {}".format(hex(0x81f00000 + i), data))
 
 
-def calc_checksum_of_firmware(fwfile, log=False):
-    """ calc checksum of firmware """
-    if log:
-        print("The size of the firmware file {} is {} ({}).".format(
-            os.path.basename(fwfile),
-            os.stat(fwfile).st_size,
-            hex(os.stat(fwfile).st_size)))
-    with open(fwfile, 'rb') as f_in:
-        raw = f_in.read()
-    checksum = 0
-    for i in range(0, len(raw), 2):
-        data = "{:02x}{:02x}".format(raw[i], raw[i+1])
-        checksum = checksum + int(data, 16)
-    if log:
-        print("Sum: {}, Invert Sum: {}".format(
-            hex(checksum & 0xffff),
-            hex((0x10000 - (checksum & 0xffff)) & 0xffff)))
-    return (0x10000 - (checksum & 0xffff)) & 0xffff
+SUM_BLOCK_SIZE = 0x100000
 
 
-def calc_sum_of_firmware(fwfile, log=False):
-    """ calc sum of firmware
-        help from @Sebastian """
-    official_firmware_sum = {
-        "linux_1.4.7_0065.bin": 0xcb43,
-        "rootfs_1.4.7_0065.bin": 0x742c,
-        "linux_1.4.6_0043.bin": 0xc8cc,
-        "rootfs_1.4.6_0043.bin": 0x742c,
-        "linux_1.4.6_0012.bin": 0xc8cf,
-        "rootfs_1.4.6_0012.bin": 0x62c6,
-        "linux_1.4.5_0016.bin": 0xe87e,
-        "rootfs_1.4.5_0016.bin": 0xa40a
-    }
-    modified_firmware_sum = {
-        "rootfs_1.4.7_0065_modified.bin": 0x742c
-    }
-    if not os.path.exists(fwfile):
-        print("The {} is not exist!".format(fwfile))
-        return '0000'
+class WordSum:
+    """ running sum of big-endian 16-bit words
+
+        An odd trailing byte is summed as it is, the same as the 2-byte
+        read loop calc_sum_of_firmware used before. """
+
+    def __init__(self):
+        self.nsum = 0
+        self.size = 0
+        self._odd = None
 
-    nsum = 0x0
+    def update(self, data):
+        """ add bytes to the sum """
+        data = memoryview(data).cast('B')
+        if not data:
+            return
+        self.size = self.size + len(data)
+        if self._odd is not None:
+            self.nsum = self.nsum + (self._odd << 8) + data[0]
+            self._odd = None
+            data = data[1:]
+        if len(data) % 2:
+            self._odd = data[-1]
+            data = data[:-1]
+        if not data:
+            return
+        numpy = None
+        if len(data) >= SUM_BLOCK_SIZE:
+            try:
+                import numpy  # pylint: disable=import-outside-toplevel
+            except ImportError:
+                pass
+        if numpy is not None:
+            self.nsum = self.nsum + int(numpy.frombuffer(
+                data, dtype='>u2').sum(dtype=numpy.uint64))
+        else:
+            words = array.array('H')
+            words.frombytes(data)
+            if sys.byteorder == 'little':
+                words.byteswap()
+            self.nsum = self.nsum + sum(words)
+
+    @property
+    def sum(self):
+        """ 16-bit sum of all words """
+        if self._odd is not None:
+            return (self.nsum + self._odd) & 0xffff
+        return self.nsum & 0xffff
+
+    @property
+    def checksum(self):
+        """ inverted 16-bit sum """
+        return (0x10000 - self.sum) & 0xffff
+
+
+def calc_words_sum(fwfile, block_size=SUM_BLOCK_SIZE):
+    """ sum of big-endian 16-bit words of a file in one pass,
+        return (sum, inverted sum) """
+    words_sum = WordSum()
     with open(fwfile, 'rb') as f_in:
+        buf = bytearray(block_size)
+        view = memoryview(buf)
         while True:
-            byte = f_in.read(2)
-            if not byte:
+            size = f_in.readinto(buf)
+            if not size:
                 break
-            byte = int.from_bytes(byte[0:2], byteorder='big')
-            nsum = nsum + byte
+            words_sum.update(view[:size])
+    return words_sum.sum, words_sum.checksum
+
+
+# sums of boot_info which can not be calculated from the image
+official_firmware_sum = {
+    "linux_1.4.7_0065.bin": 0xcb43,
+    "rootfs_1.4.7_0065.bin": 0x742c,
+    "linux_1.4.6_0043.bin": 0xc8cc,
+    "rootfs_1.4.6_0043.bin": 0x742c,
+    "linux_1.4.6_0012.bin": 0xc8cf,
+    "rootfs_1.4.6_0012.bin": 0x62c6,
+    "linux_1.4.5_0016.bin": 0xe87e,
+    "rootfs_1.4.5_0016.bin": 0xa40a
+}
+modified_firmware_sum = {
+    "rootfs_1.4.7_0065_modified.bin": 0x742c
+}
 
-    for key, val in official_firmware_sum.items():
-        if key in os.path.basename(fwfile):
-            nsum = val
-            break
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CACHE_DIR = os.environ.get('GATEWAY3_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', 'gateway3utils'))
+# size limit of the prepared artifacts in MB
+ARTIFACT_CACHE_SIZE = int(os.environ.get('GATEWAY3_CACHE_SIZE', '512'))
+ARTIFACT_CACHE_ENTRIES = 1000
+# seconds after which a file in the cache of no entry is removed
+ARTIFACT_TEMP_AGE = 3600
+
+
+def _known_firmware_sum(fwfile):
+    """ official or modified sum matched by the file name """
+    for table in (official_firmware_sum, modified_firmware_sum):
+        for key, val in table.items():
+            if key in os.path.basename(fwfile):
+                return val
+    return None
+
+
+def _scan_firmware(fwfile, block_size=SUM_BLOCK_SIZE):
+    """ sha256 and word sum of a file in one pass """
+    words_sum = WordSum()
+    sha256 = hashlib.sha256()
+    with open(fwfile, 'rb') as f_in:
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        while True:
+            size = f_in.readinto(buf)
+            if not size:
+                break
+            words_sum.update(view[:size])
+            sha256.update(view[:size])
+    size = words_sum.size
+    return sha256.hexdigest(), {
+        'size': size,
+        'padded_size': size + (-size % 0x20000),
+        'sum': words_sum.sum,
+        'checksum': words_sum.checksum}
+
+
+class SumCache:
+    """ on-disk cache of firmware sums keyed by sha256 of the content
+
+        files maps a path to (size, mtime_ns, sha256), so a file which is
+        not changed is looked up without reading it. The official sums
+        matched by file name are not cached, they are looked up by the
+        callers. The station threads share the cache, lock guards the
+        dicts and the file. """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, 'sums.json')
+        self.lock = threading.Lock()
+        self.files = {}
+        self.contents = {}
+        try:
+            with open(self.path, 'r') as f_in:
+                data = json.load(f_in)
+            self.files = data.get('files', {})
+            self.contents = data.get('contents', {})
+        except (OSError, ValueError):
+            pass
+
+    def _lookup(self, fwfile, save=True):
+        """ (sha256, entry) of fwfile, calculate it if it is not cached """
+        path = os.path.abspath(fwfile)
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.files.get(path)
+            if (cached is not None and cached[0] == stat.st_size and
+                    cached[1] == stat.st_mtime_ns and
+                    cached[2] in self.contents):
+                return cached[2], self.contents[cached[2]]
+        # the file is read without the lock, a file summed by two threads
+        # at once gets the same entry twice
+        digest, entry = _scan_firmware(path)
+        with self.lock:
+            self.contents[digest] = entry
+            self.files[path] = (stat.st_size, stat.st_mtime_ns, digest)
+            if save:
+                self._save()
+        return digest, entry
+
+    def lookup(self, fwfile, save=True):
+        """ entry of fwfile, calculate it if it is not cached """
+        return self._lookup(fwfile, save)[1]
+
+    def digest(self, fwfile):
+        """ sha256 of the content of fwfile, read only if it changed """
+        return self._lookup(fwfile)[0]
+
+    def seed(self, entries):
+        """ add the files of catalog entries, which are scanned already """
+        with self.lock:
+            for path, entry in entries.items():
+                self.files[path] = (entry['size'], entry['mtime_ns'],
+                                    entry['sha256'])
+                self.contents[entry['sha256']] = {
+                    key: entry[key] for key in
+                    ('size', 'padded_size', 'sum', 'checksum')}
+            self._save()
+
+    def save(self):
+        """ write the cache atomically """
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        """ write the cache atomically, with lock held """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(self.path),
+                    delete=False) as f_out:
+                json.dump({'files': self.files,
+                           'contents': self.contents}, f_out)
+            os.replace(f_out.name, self.path)
+        except OSError:
+            pass
+
+
+_sum_cache = None
+_sum_cache_lock = threading.Lock()
+
+
+def get_sum_cache():
+    """ the sum cache of this process """
+    global _sum_cache  # pylint: disable=global-statement
+    with _sum_cache_lock:
+        if _sum_cache is None:
+            _sum_cache = SumCache()
+    return _sum_cache
+
+
+class ArtifactCache:
+    """ on-disk cache of prepared images keyed by the sha256 of their
+        content, and the fw type for the fw_update-wrapped ones
+
+        Each entry has a meta dict and optionally a file. Entries are
+        evicted least recently used first when the files exceed
+        max_size bytes or there are more than ARTIFACT_CACHE_ENTRIES,
+        except the ones used by this process. The index is written
+        on put() and evict() only, merged with the index on disk under
+        a lock of index.lock, so that processes sharing the cache keep
+        the entries of each other. """
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or os.path.join(CACHE_DIR, 'artifacts')
+        self.max_size = ARTIFACT_CACHE_SIZE << 20 if max_size is None \
+            else max_size
+        self.lock = threading.RLock()
+        self.pinned = set()
+        # keys used, put or found gone by this process, merged on save
+        self.touched = set()
+        self.removed = set()
+        # files of new_file() which are not put() yet
+        self.temps = set()
+        self.entries = self._read_index()
+
+    def _read_index(self):
+        """ entries of index.json, empty if it does not exist """
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r') as f_in:
+                return json.load(f_in)
+        except (OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """ hold the lock of this process and, where fcntl exists, an
+            exclusive lock of index.lock against the other processes """
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                import fcntl  # pylint: disable=import-outside-toplevel
+            except ImportError:
+                fcntl = None
+            with open(os.path.join(self.path, 'index.lock'), 'a') as f_lock:
+                if fcntl is not None:
+                    fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def file(self, entry):
+        """ path of the file of entry, None if it has none """
+        if entry.get('file') is None:
+            return None
+        return os.path.join(self.path, entry['file'])
+
+    def get(self, key):
+        """ entry of key marked as used, None if it is not cached or its
+            file is gone """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.get('file') is not None and \
+                    not os.path.isfile(self.file(entry)):
+                del self.entries[key]
+                self.removed.add(key)
+                return None
+            entry['used'] = time.time()
+            self.pinned.add(key)
+            self.touched.add(key)
+            return entry
+
+    def new_file(self, suffix=''):
+        """ path of a temporary file in the cache to be put() or
+            discard() """
+        os.makedirs(self.path, exist_ok=True)
+        f_tmp = tempfile.NamedTemporaryFile(dir=self.path, suffix=suffix,
+                                            delete=False)
+        f_tmp.close()
+        with self.lock:
+            self.temps.add(f_tmp.name)
+        return f_tmp.name
+
+    def discard(self, path):
+        """ remove a file of new_file() which is not put() """
+        with self.lock:
+            self.temps.discard(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def put(self, key, meta, source=None):
+        """ cache meta and the file source, moved into the cache as key,
+            then evict the least recently used entries """
+        with self.lock:
+            entry = {'meta': meta, 'file': None, 'size': 0,
+                     'used': time.time()}
+            if source is not None:
+                entry['file'] = key
+                os.makedirs(self.path, exist_ok=True)
+                os.replace(source, self.file(entry))
+                self.temps.discard(source)
+                entry['size'] = os.stat(self.file(entry)).st_size
+            self.entries[key] = entry
+            self.removed.discard(key)
+            self.pinned.add(key)
+            self.touched.add(key)
+            self.evict()
+            return entry
+
+    def total_size(self):
+        """ bytes of the cached files """
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def _merge(self):
+        """ take the index on disk and apply the changes of this process """
+        entries = self._read_index()
+        for key in self.removed:
+            entries.pop(key, None)
+        for key in self.touched:
+            if key in self.entries:
+                entries[key] = self.entries[key]
+        self.entries = entries
+        self.touched = set()
+        self.removed = set()
+
+    def _remove_unindexed(self):
+        """ remove the files of no entry left by an interrupted run, the
+            ones younger than ARTIFACT_TEMP_AGE may be in use """
+        indexed = set(entry['file'] for entry in self.entries.values()
+                      if entry.get('file') is not None)
+        indexed.update(('index.json', 'index.lock'))
+        now = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if name in indexed or path in self.temps or \
+                        now - os.stat(path).st_mtime < ARTIFACT_TEMP_AGE:
+                    continue
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """ remove the least recently used entries over max_size and the
+            files of no entry, then save the index """
+        try:
+            with self._locked_index():
+                self._merge()
+                for key in sorted(self.entries,
+                                  key=lambda key: self.entries[key]['used']):
+                    over_size = self.total_size() > self.max_size
+                    if not over_size and \
+                            len(self.entries) <= ARTIFACT_CACHE_ENTRIES:
+                        break
+                    if key in self.pinned or \
+                            (over_size and not self.entries[key]['size']):
+                        continue
+                    if self.entries[key]['size']:
+                        try:
+                            os.remove(self.file(self.entries[key]))
+                        except OSError:
+                            pass
+                    del self.entries[key]
+                self._remove_unindexed()
+                self._save()
+        except OSError:
+            pass
+
+    def _save(self):
+        """ write the index atomically, with index.lock held """
+        with tempfile.NamedTemporaryFile(
+                'w', dir=self.path, delete=False) as f_out:
+            json.dump(self.entries, f_out)
+        os.replace(f_out.name, os.path.join(self.path, 'index.json'))
+
+
+_artifact_cache = None
 
-    for key, val in modified_firmware_sum.items():
-        if key in os.path.basename(fwfile):
-            nsum = val
-            break
+
+def get_artifact_cache():
+    """ the artifact cache of this process """
+    global _artifact_cache  # pylint: disable=global-statement
+    if _artifact_cache is None:
+        _artifact_cache = ArtifactCache()
+    return _artifact_cache
+
+
+def calc_checksum_of_firmware(fwfile, log=False, data=None):
+    """ calc checksum of firmware, or of data named fwfile """
+    if data is not None:
+        words_sum = WordSum()
+        words_sum.update(data)
+        entry = {'size': words_sum.size, 'sum': words_sum.sum,
+                 'checksum': words_sum.checksum}
+    else:
+        entry = get_sum_cache().lookup(fwfile)
+    if log:
+        print("The size of the firmware file {} is {} ({}).".format(
+            os.path.basename(fwfile), entry['size'], hex(entry['size'])))
+        print("Sum: {}, Invert Sum: {}".format(
+            hex(entry['sum']), hex(entry['checksum'])))
+    return entry['checksum']
+
+
+def calc_sum_of_firmware(fwfile, log=False, data=None):
+    """ calc sum of firmware, or of data named fwfile
+        help from @Sebastian """
+    if data is not None:
+        nsum = _known_firmware_sum(fwfile)
+        if nsum is None:
+            words_sum = WordSum()
+            words_sum.update(data)
+            nsum = words_sum.sum
+    elif not os.path.exists(fwfile):
+        print("The {} is not exist!".format(fwfile))
+        return '0000'
+    else:
+        nsum = _known_firmware_sum(fwfile)
+        if nsum is None:
+            nsum = get_sum_cache().lookup(fwfile)['sum']
 
     if log:
         print('{}'.format(hex(nsum & 0xFFFF)))
     return "{}".format(hex(nsum & 0xFFFF))
 
 
+BOOT_INFO_SIZE = 55
+BOOT_INFO_MAGIC = 0x917c
+BOOT_INFO_VERNUM = 0
+BOOT_INFO_OFFSET = 0xa0000
+BOOT_INFO_DDR_BASE = 0xa0a00000
+# boot_info_t of binutils/src/boot_ctrl/boot_ctrl.c: magic, vernum and
+# check_sum are little-endian, sizes and sums are stored big-endian
+BOOT_INFO_HEAD = struct.Struct('<HHH4B')
+BOOT_INFO_BODY = struct.Struct('>IHBIHBIHBIHBBBB9s5s')
+# fields of boot_info.yaml which are 0 when they are missing, the others
+# keep the values of the original firmware
+BOOT_INFO_ZERO_FIELDS = (
+    'kernel_curr', 'rootfs_curr', 'kernel_newest', 'rootfs_newest',
+    'kernel0_size', 'kernel0_checksum', 'kernel0_fail',
+    'kernel1_size', 'kernel1_checksum', 'kernel1_fail',
+    'rootfs0_size', 'rootfs0_checksum', 'rootfs0_fail',
+    'rootfs1_size', 'rootfs1_checksum', 'rootfs1_fail')
+BOOT_INFO_FIELDS = (
+    'magic', 'vernum', 'check_sum',
+    'kernel_curr', 'rootfs_curr', 'kernel_newest', 'rootfs_newest',
+    'kernel0_size', 'kernel0_checksum', 'kernel0_fail',
+    'kernel1_size', 'kernel1_checksum', 'kernel1_fail',
+    'rootfs0_size', 'rootfs0_checksum', 'rootfs0_fail',
+    'rootfs1_size', 'rootfs1_checksum', 'rootfs1_fail',
+    'root_sum_check', 'watchdog_time', 'priv_mode', 'version', 'reserved')
+
+
+class BootInfo(collections.namedtuple('BootInfo', BOOT_INFO_FIELDS)):
+    """ the 55 bytes of the boot_info partition """
+    __slots__ = ()
+
+    @classmethod
+    def default(cls):
+        """ boot_info of the original firmware, sealed """
+        return cls(
+            BOOT_INFO_MAGIC, BOOT_INFO_VERNUM, 0xffff, 0, 0, 0, 0,
+            2157572, 0xcb43, 0, 2126852, 0xe87e, 0,
+            10108932, 0x742c, 0, 7704580, 0xa40a, 0,
+            0, 0, 1, b'1.0.2.005', bytes(5)).seal()
+
+    @classmethod
+    def unpack(cls, data):
+        """ BootInfo of the first 55 bytes of data """
+        return cls(*(BOOT_INFO_HEAD.unpack_from(data) +
+                     BOOT_INFO_BODY.unpack_from(data, BOOT_INFO_HEAD.size)))
+
+    @classmethod
+    def load(cls, path):
+        """ BootInfo of a boot_info.bin backup """
+        with open(path, 'rb') as f_in:
+            return cls.unpack(f_in.read(BOOT_INFO_SIZE))
+
+    @classmethod
+    def from_conf(cls, conf):
+        """ sealed BootInfo of the default updated by conf,
+            a dict of field names as in boot_info.yaml, the missing
+            BOOT_INFO_ZERO_FIELDS are 0 """
+        info = cls.default()
+        values = dict.fromkeys(BOOT_INFO_ZERO_FIELDS, 0)
+        for key, value in conf.items():
+            if key not in cls._fields or key in ('magic', 'check_sum'):
+                continue
+            if key in ('version', 'reserved'):
+                value = str(value).encode()
+            elif isinstance(value, str):
+                value = int(value, 0)
+            values[key] = value
+        return info._replace(**values).seal()
+
+    def pack(self):
+        """ 55 bytes of the boot_info """
+        return BOOT_INFO_HEAD.pack(*self[:7]) + BOOT_INFO_BODY.pack(*self[7:])
+
+    def calc_checksum(self):
+        """ checksum of boot_ctrl: 0xffff minus the bytes from offset 6,
+            even bytes from the low byte and odd bytes from the high one,
+            each borrowing from the other """
+        base = [0xff, 0xff]
+        for i, value in enumerate(self.pack()[6:], 6):
+            if value > base[i % 2]:
+                base[1 - i % 2] = (base[1 - i % 2] - 1) & 0xff
+                base[i % 2] = 256 + base[i % 2] - value
+            else:
+                base[i % 2] = base[i % 2] - value
+        return base[1] << 8 | base[0]
+
+    def seal(self):
+        """ copy with the checksum updated """
+        return self._replace(check_sum=self.calc_checksum())
+
+    def validate(self):
+        """ list of errors, empty if the boot_info is valid """
+        errors = []
+        if self.magic != BOOT_INFO_MAGIC:
+            errors.append('magic {:#06x}'.format(self.magic))
+        if self.vernum != BOOT_INFO_VERNUM:
+            errors.append('vernum {}'.format(self.vernum))
+        if self.check_sum != self.calc_checksum():
+            errors.append('check_sum {:#06x}, {:#06x} expected'.format(
+                self.check_sum, self.calc_checksum()))
+        for field in ('kernel_curr', 'rootfs_curr',
+                      'kernel_newest', 'rootfs_newest'):
+            if getattr(self, field) not in (0, 1):
+                errors.append('{} {}'.format(field, getattr(self, field)))
+        return errors
+
+    def diff(self, other):
+        """ list of (field, self value, other value) which differ """
+        return [(field, mine, theirs) for field, mine, theirs in
+                zip(self._fields, self, other) if mine != theirs]
+
+    def show(self):
+        """ text like boot_ctrl show """
+        lines = ['vernum: {}'.format(self.vernum),
+                 'bversion: {}'.format(
+                     self.version.rstrip(b'\0').decode(errors='replace')),
+                 'kernel: {} {}'.format(self.kernel_newest, self.kernel_curr),
+                 'rootfs: {} {}'.format(self.rootfs_newest, self.rootfs_curr)]
+        for name in ('kernel0', 'kernel1', 'rootfs0', 'rootfs1'):
+            lines.append('{}_{}: {} {:x} {}'.format(
+                name[:-1], name[-1], getattr(self, name + '_fail'),
+                getattr(self, name + '_checksum'),
+                getattr(self, name + '_size')))
+        lines.append('root_sum_check: {}'.format(
+            'on' if self.root_sum_check else 'off'))
+        lines.append('priv_mode: {}'.format(
+            'on' if self.priv_mode else 'off'))
+        return '\n'.join(lines)
+
+    def commands(self, ddr_base=BOOT_INFO_DDR_BASE, offset=BOOT_INFO_OFFSET):
+        """ eb and NANDW commands programming the boot_info """
+        data = self.pack()
+        commands = ["eb {} {}\n".format(
+            hex(ddr_base + i), " ".join("{:02x}".format(c)
+                                        for c in data[i:i+16]))
+                    for i in range(0, len(data), 16)]
+        commands.append("NANDW {} {} {}\n".format(
+            hex(offset), hex(ddr_base), len(data)))
+        return "".join(commands)
+
+
 def calc_checksum_boot_info(info_file, log=False):
-    """ calc_boot_info """
-    boot_info = {
-        'magic_1': 0x7c,
-        'magic_2': 0x91,
-        'vernum_1': 0x00,
-        'vernum_2': 0x00,
-        'check_sum_1': 0xff,
-        'check_sum_2': 0xff,
-        'kernel_curr': 0x0,
-        'rootfs_curr': 0x0,
-        'kernel_newest': 0x0,
-        'rootfs_newest': 0x0,
-        'kernel0_size_1': 0x00,
-        'kernel0_size_2': 0x20,
-        'kernel0_size_3': 0xec,
-        'kernel0_size_4': 0x04,
-        'kernel0_checksum_1': 0xcb,
-        'kernel0_checksum_2': 0x43,
-        'kernel0_fail': 0x0,
-        'kernel1_size_1': 0x0,
-        'kernel1_size_2': 0x20,
-        'kernel1_size_3': 0x74,
-        'kernel1_size_4': 0x04,
-        'kernel1_checksum_1': 0xe8,
-        'kernel1_checksum_2': 0x7e,
-        'kernel1_fail': 0x0,
-        'rootfs0_size_1': 0x0,
-        'rootfs0_size_2': 0x9a,
-        'rootfs0_size_3': 0x40,
-        'rootfs0_size_4': 0x04,
-        'rootfs0_checksum_1': 0x74,
-        'rootfs0_checksum_2': 0x2c,
-        'rootfs0_fail': 0x0,
-        'rootfs1_size_1': 0x0,
-        'rootfs1_size_2': 0x75,
-        'rootfs1_size_3': 0x90,
-        'rootfs1_size_4': 0x04,
-        'rootfs1_checksum_1': 0xa4,
-        'rootfs1_checksum_2': 0x0a,
-        'rootfs1_fail': 0x0,
-        'root_sum_check': 0x0,
-        'watchdog_time': 0x0,
-        'priv_mode': 0x1,
-        # 'version': '1.0.2.005',
-        'version_1': 0x31,
-        'version_2': 0x2e,
-        'version_3': 0x30,
-        'version_4': 0x2e,
-        'version_5': 0x32,
-        'version_6': 0x2e,
-        'version_7': 0x30,
-        'version_8': 0x30,
-        'version_9': 0x35,
-        'reserved_1': 0x0,
-        'reserved_2': 0x0,
-        'reserved_3': 0x0,
-        'reserved_4': 0x0,
-        'reserved_5': 0x0,
-    }
-    if "yaml" not in sys.modules or not os.path.isfile(info_file):
+    """ commands programming the boot_info of a yaml file """
+    try:
+        import yaml  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        yaml = None
+    if yaml is None or not os.path.isfile(info_file):
         print("Yaml file Error!")
         return ""
 
     with open(info_file, "r") as f_in:
-        conf = yaml.safe_load(f_in)
-    for i in range(4, 0, -1):
-        boot_info['kernel0_size_{}'.format(5 - i)] = (
-            conf.get('kernel0_size', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['kernel1_size_{}'.format(5 - i)] = (
-            conf.get('kernel1_size', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['rootfs0_size_{}'.format(5 - i)] = (
-            conf.get('rootfs0_size', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['rootfs1_size_{}'.format(5 - i)] = (
-            conf.get('rootfs1_size', 0x0) >> (i - 1) * 8) & 0xff
-
-    for i in range(2, 0, -1):
-        boot_info['kernel0_checksum_{}'.format(3 - i)] = (
-            conf.get('kernel0_checksum', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['kernel1_checksum_{}'.format(3 - i)] = (
-            conf.get('kernel1_checksum', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['rootfs0_checksum_{}'.format(3 - i)] = (
-            conf.get('rootfs0_checksum', 0x0) >> (i - 1) * 8) & 0xff
-        boot_info['rootfs1_checksum_{}'.format(3 - i)] = (
-            conf.get('rootfs1_checksum', 0x0) >> (i - 1) * 8) & 0xff
-    boot_info['kernel0_fail'] = conf.get('kernel0_fail', 0x0)
-    boot_info['kernel1_fail'] = conf.get('kernel1_fail', 0x0)
-    boot_info['rootfs0_fail'] = conf.get('rootfs0_fail', 0x0)
-    boot_info['rootfs1_fail'] = conf.get('rootfs1_fail', 0x0)
-
-    boot_info['kernel_curr'] = conf.get('kernel_curr', 0x0)
-    boot_info['rootfs_curr'] = conf.get('rootfs_curr', 0x0)
-    boot_info['kernel_newest'] = conf.get('kernel_newest', 0x0)
-    boot_info['rootfs_newest'] = conf.get('rootfs_newest', 0x0)
-
-    keys = list(boot_info.keys())
-    values = list(boot_info.values())
-    for i in range(6, len(keys)):
-        if i % 2 == 0:
-            if values[i] > values[4]:
-                values[5] = values[5] - 1
-                values[4] = 256 + values[4] - values[i]
-            else:
-                values[4] = values[4] - values[i]
-        else:
-            if values[i] > values[5]:
-                values[4] = values[4] - 1
-                values[5] = 256 + values[5] - values[i]
-            else:
-                values[5] = values[5] - values[i]
-    new_checksum_1 = '0x{:02x}'.format(values[4])
-    new_checksum_2 = '0x{:02x}'.format(values[5])
+        info = BootInfo.from_conf(yaml.safe_load(f_in) or {})
+    commands = info.commands()
     if log:
-        print('New checksum: {} {}'.format(new_checksum_1, new_checksum_2))
-        for i in range(0, len(values), 16):
-            data = " ".join("{:02x}".format(c) for c in values[i:i+16])
-            print("eb {} {}".format(hex(0xa0a00000 + i), data))
-        print("NANDW 0xa0000 0xa0a00000 55")
-    commands = ""
-    for i in range(0, len(values), 16):
-        data = " ".join("{:02x}".format(c) for c in values[i:i+16])
-        commands = "{}eb {} {}\n".format(commands, hex(0xa0a00000 + i), data)
-    return "{}NANDW 0xa0000 0xa0a00000 55\n".format(commands)
-
-
-def generate_firmware_for_fw_update(fwfile, fwtype):
-    """ generate firmware for fw_update """
+        print('New checksum: 0x{:02x} 0x{:02x}'.format(
+            info.check_sum & 0xff, info.check_sum >> 8))
+        print(commands, end='')
+    return commands
+
+
+def show_boot_info(info_file, other_file=None):
+    """ show and validate a boot_info.bin backup, or diff it with
+        other_file """
+    info = BootInfo.load(info_file)
+    if other_file is None:
+        print(info.show())
+        for error in info.validate():
+            print("Invalid {}!".format(error))
+        return not info.validate()
+    other = BootInfo.load(other_file)
+    for field, mine, theirs in info.diff(other):
+        print("{}: {} -> {}".format(field, mine, theirs))
+    return info == other
+
+
+def _boot_info_records(source):
+    """ (name, conf) of the yaml files of a directory or rows of a CSV
+        file with a name column """
+    if os.path.isdir(source):
+        import yaml  # pylint: disable=import-outside-toplevel
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        for path in sorted(glob.glob(os.path.join(source, '*.y*ml'))):
+            with open(path, 'r') as f_in:
+                yield (os.path.splitext(os.path.basename(path))[0],
+                       yaml.load(f_in, Loader=loader) or {})
+    else:
+        with open(source, 'r', newline='') as f_in:
+            for index, row in enumerate(csv.DictReader(f_in)):
+                name = row.pop('name', None) or str(index)
+                yield name, {key: value for key, value in row.items()
+                             if value not in (None, '')}
+
+
+def generate_boot_info_batch(source, outdir):
+    """ write outdir/NAME.txt of commands for each record of source,
+        return the count of scripts """
+    os.makedirs(outdir, exist_ok=True)
+    count = 0
+    for name, conf in _boot_info_records(source):
+        try:
+            info = BootInfo.from_conf(conf)
+        except (TypeError, ValueError, struct.error) as err:
+            print("Skip {}: {}".format(name, err))
+            continue
+        with open(os.path.join(outdir, '{}.txt'.format(name)), 'w') as f_out:
+            f_out.write(info.commands())
+        count = count + 1
+    print("Generated {} boot_info scripts in {}.".format(count, outdir))
+    return count
+
+
+def generate_firmware_for_fw_update(fwfile, fwtype, filename=None):
+    """ generate firmware for fw_update, into filename if it is set """
     firmware_type = {
         'header': '4D494F540011001307110F05',
         'gbl': '0F133FCDA8FC0404FC040000',
@@ -282,107 +786,738 @@ def generate_firmware_for_fw_update(fwfile, fwtype):
     if not firmware_type.get(fwtype):
         print("The type {} is incorrect!".format(fwtype))
         return None
+    fwsize = os.stat(fwfile).st_size
+    if filename is None:
+        filename = "{}_fw_update.bin".format(os.path.splitext(fwfile)[0])
+    align_size = firmware_align_size.get(fwtype, 0x200)
+    if fwsize % align_size >= 1:
+        pad_number = align_size - (fwsize % align_size)
+    else:
+        pad_number = 0
+
+    words_sum = WordSum()
+    buf = bytearray(SUM_BLOCK_SIZE)
+    view = memoryview(buf)
     with open(fwfile, 'rb') as f_in:
-        raw = f_in.read(16)
-        if raw[:4] == b'cr6c' or raw[:4] == b'r6cr':
+        size = f_in.readinto(buf)
+        if view[:4] == b'cr6c' or view[:4] == b'r6cr':
             print("It is ready for fw_update!")
             return fwfile
-    with open(fwfile, 'rb') as f_in:
-        raw = f_in.read()
-    data = calc_checksum_of_firmware(fwfile)
-    fwsize = os.stat(fwfile).st_size
-    filename = "{}_fw_update.bin".format(os.path.splitext(fwfile)[0])
-    align_size = firmware_align_size.get(fwtype, 0x200)
-    with open(filename, "wb") as f_out:
-        if fwsize % align_size >= 1:
-            pad_number = align_size - (fwsize % align_size)
-        else:
-            pad_number = 0
-        padding = [0 for _ in range(pad_number + align_size)]
-        f_out.write(binascii.unhexlify(firmware_type[fwtype]))
-        f_out.write((fwsize + pad_number + align_size + 4).to_bytes(
-            4, byteorder='big', signed=False))
-        f_out.write(raw)
-        if data >= 1:
-            f_out.write(bytearray(padding))
-            f_out.write(data.to_bytes(4, byteorder='big', signed=False))
+        with open(filename, "wb") as f_out:
+            f_out.write(binascii.unhexlify(firmware_type[fwtype]))
+            f_out.write((fwsize + pad_number + align_size + 4).to_bytes(
+                4, byteorder='big', signed=False))
+            while size:
+                words_sum.update(view[:size])
+                f_out.write(view[:size])
+                size = f_in.readinto(buf)
+            data = words_sum.checksum
+            if data >= 1:
+                f_out.write(bytes(pad_number + align_size))
+                f_out.write(data.to_bytes(4, byteorder='big', signed=False))
     print("Generated {} ({}) done.".format(
         filename, os.stat(filename).st_size))
     return filename
 
 
-def _extract_firmwares(fwfile):
-    """ extract firmwares """
+ERASE_BLOCK_SIZE = 0x20000
+MIOT_HEADER_LENGTH = 17
+MIOT_SECTION_HEADER_LENGTH = 10
+GBL_MAGIC = b'\xeb\x17\xa6\x03'
+# sections of MIOT all-in-one firmware in order, None is not checked
+MIOT_SECTIONS = (
+    ('bootloader', GBL_MAGIC),
+    ('full', GBL_MAGIC),
+    ('linux', b'cr6c'),
+    ('ota', None),
+    ('rootfs', b'r6cr'),
+)
+
+MiotSection = collections.namedtuple(
+    'MiotSection', ['name', 'offset', 'length', 'magic', 'version'])
+
+
+def _map_file(fwfile):
+    """ read-only memoryview of a file backed by mmap """
+    with open(fwfile, 'rb') as f_in:
+        if not os.fstat(f_in.fileno()).st_size:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f_in.fileno(), 0,
+                                    access=mmap.ACCESS_READ))
+
+
+class MiotBundle:
+    """ lazy section table of MIOT all-in-one firmware """
     # 0x2e00 (apploader.bin)
     # sizeof(full.gbl)_and_other_10bytes
     # full.gbl 10bytes linux  ota-files.bin 10bytes rootfs.bin cert
 
+    def __init__(self, fwfile, sections=None):
+        self.fwfile = fwfile
+        self.data = _map_file(fwfile)
+        self._sections = sections
+
+    @property
+    def sections(self):
+        """ section table, parsed on first use """
+        if self._sections is None:
+            self._sections = self._parse()
+        return self._sections
+
+    def _parse(self):
+        sections = collections.OrderedDict()
+        offset = MIOT_HEADER_LENGTH
+        for name, magic in MIOT_SECTIONS:
+            header = self.data[offset:offset + MIOT_SECTION_HEADER_LENGTH]
+            if len(header) < MIOT_SECTION_HEADER_LENGTH:
+                return None
+            length = int.from_bytes(header[:4], byteorder='big')
+            if (length < MIOT_SECTION_HEADER_LENGTH or
+                    offset + length > len(self.data)):
+                return None
+            start = offset + MIOT_SECTION_HEADER_LENGTH
+            section_magic = bytes(self.data[start:start + 4])
+            if magic is not None and section_magic != magic:
+                return None
+            sections[name] = MiotSection(
+                name, start, length - MIOT_SECTION_HEADER_LENGTH,
+                section_magic, int.from_bytes(header[8:10], byteorder='big'))
+            offset = offset + length
+        return sections
+
+    def is_valid(self):
+        """ check the magic and the section table """
+        return (self.data[:4] == b'MIOT' and
+                self.sections is not None)
+
+    def section_data(self, name):
+        """ zero-copy view of a section """
+        section = self.sections[name]
+        return self.data[section.offset:section.offset + section.length]
+
+
+def _extract_firmwares(fwfile):
+    """ index the firmwares of MIOT all-in-one firmware """
+    entry = get_catalog().lookup(fwfile)
+    if entry is None or entry['kind'] != 'miot':
+        return None
+    return MiotBundle(fwfile, collections.OrderedDict(
+        (section[0], MiotSection(section[0], section[1], section[2],
+                                 bytes.fromhex(section[3]), section[4]))
+        for section in entry['sections']))
+
+
+FIRMWARE_KINDS_OF_TYPE = {
+    'linux': ('cr6c', 'linux_raw'),
+    'rootfs': ('r6cr', 'hsqs'),
+    'silabs_ncp_bt': ('gbl',),
+    'all': ('miot',),
+}
+
+
+def detect_firmware_kind(head):
+    """ kind of firmware from its first 64 bytes """
+    if head[:4] in (b'cr6c', b'r6cr', b'hsqs'):
+        return head[:4].decode()
+    if head[:4] == b'MIOT':
+        return 'miot'
+    if head[:4] == GBL_MAGIC:
+        return 'gbl'
+    if head[:4] == b'\x1e\xf1\xee\x0b':
+        return 'zigbee_ota'
+    if (head[:8] == b'\x00\x00\x00\x00\x00\x00\x00\x00' and
+            head[44:52] == b'\x21\x80\x00\x00\x00\x60\x90\x40'):
+        return 'linux_raw'
+    return 'unknown'
+
+
+def _sniff_firmware(fwfile, head=None):
+    """ kind and sections of a file from its header, it is not hashed """
+    if head is None:
+        with open(fwfile, 'rb') as f_in:
+            head = f_in.read(64)
+    entry = {'kind': detect_firmware_kind(head), 'sections': []}
+    if entry['kind'] == 'miot':
+        sections = MiotBundle(fwfile).sections
+        if sections is None:
+            entry['kind'] = 'unknown'
+        else:
+            entry['sections'] = [
+                [section.name, section.offset, section.length,
+                 section.magic.hex(), section.version]
+                for section in sections.values()]
+    return entry
+
+
+def _catalog_entry(fwfile):
+    """ catalog entry of a file, run in the worker processes """
+    stat = os.stat(fwfile)
+    digest, entry = _scan_firmware(fwfile)
     with open(fwfile, 'rb') as f_in:
-        # Header
-        header_length = 17
-        f_in.seek(header_length)
-        data = f_in.read(4).hex()
-        bl_gbl_length = int(data, 16)
-        f_in.read(4)
-        fwversion = int(f_in.read(2).hex(), 16)
-        # bootloader.gbl
-        data = f_in.read(bl_gbl_length - 10)
-        if data[:4] != b'\xeb\x17\xa6\x03':
-            return False
-        with open('bootloader_{}.gbl'.format(fwversion), 'wb') as f_out:
-            f_out.write(data)
-        data = f_in.read(4).hex()
-        full_gbl_length = int(data, 16)
-        f_in.read(4)
-        fwversion = int(f_in.read(2).hex(), 16)
-        # full.gbl
-        data = f_in.read(full_gbl_length - 10)
-        if data[:4] != b'\xeb\x17\xa6\x03':
-            return False
-        with open('full_{}.gbl'.format(fwversion), 'wb') as f_out:
-            f_out.write(data)
-        f_in.seek(header_length + bl_gbl_length + full_gbl_length)
-        data = f_in.read(4).hex()
-        linux_length = int(data, 16)
-        f_in.seek(header_length + bl_gbl_length + full_gbl_length + 10)
-        data = f_in.read(linux_length - 10)
-        if data[:4] != b'cr6c':
-            return False
-        with open('linux.bin', 'wb') as f_out:
-            f_out.write(data)
-        f_in.seek(header_length + bl_gbl_length + full_gbl_length +
-                  linux_length)
-        data = f_in.read(4).hex()
-        ota_file_length = int(data, 16)
-        # bypass ota-file
-        f_in.seek(header_length + bl_gbl_length + full_gbl_length +
-                  linux_length + ota_file_length)
-        data = f_in.read(4).hex()
-        rootfs_length = int(data, 16)
-        f_in.seek(header_length + bl_gbl_length + full_gbl_length +
-                  linux_length + ota_file_length + 10)
-        data = f_in.read(rootfs_length - 10)
-        if data[:4] != b'r6cr':
-            return False
-        with open('rootfs.bin', 'wb') as f_out:
-            f_out.write(data)
-        return True
+        head = f_in.read(64)
+    entry.update(_sniff_firmware(fwfile, head))
+    entry.update({'mtime_ns': stat.st_mtime_ns, 'sha256': digest})
+    version = re.search(r'([0-9]\.[0-9]\.[0-9]_[0-9]+)', fwfile)
+    entry['version'] = None if version is None else version.group(1)
+    if entry['kind'] == 'gbl':
+        version = re.search(r'_([0-9]+)\.gbl', fwfile)
+        entry['version'] = entry['version'] if version is None else \
+            version.group(1)
+    elif entry['kind'] == 'zigbee_ota':
+        entry['version'] = '{:08x}'.format(
+            int.from_bytes(head[14:18], byteorder='little'))
+    return entry
+
+
+class Catalog:
+    """ manifest of firmware files indexed by path
+
+        Only the files which size or mtime are changed are scanned again
+        by update(). """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(CACHE_DIR, 'catalog.json')
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as f_in:
+                self.entries = json.load(f_in)
+        except (OSError, ValueError):
+            pass
+
+    def _is_fresh(self, path, stat):
+        entry = self.entries.get(path)
+        return (entry is not None and entry['size'] == stat.st_size and
+                entry['mtime_ns'] == stat.st_mtime_ns)
+
+    def update(self, dirs, workers=None):
+        """ scan dirs with a process pool, return the count of scanned """
+        files = []
+        for path in dirs:
+            for root, _, names in os.walk(path):
+                files.extend(os.path.abspath(os.path.join(root, name))
+                             for name in names)
+        changed = [path for path in files
+                   if not self._is_fresh(path, os.stat(path))]
+        for path in [path for path in self.entries
+                     if not os.path.exists(path)]:
+            del self.entries[path]
+        if changed:
+            import concurrent.futures  # noqa pylint: disable=import-outside-toplevel
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                for path, entry in zip(changed,
+                                       pool.map(_catalog_entry, changed)):
+                    self.entries[path] = entry
+        self.save()
+        return len(changed)
+
+    def lookup(self, fwfile):
+        """ entry of fwfile if it is fresh, else its kind and sections
+            sniffed from the header; only update() adds entries """
+        path = os.path.abspath(fwfile)
+        if not os.path.isfile(path):
+            return None
+        if self._is_fresh(path, os.stat(path)):
+            return self.entries[path]
+        return _sniff_firmware(path)
+
+    def find(self, version, fwtype):
+        """ (path, section) of the firmware for version and fwtype like
+            rootfs_1, section is the name in MIOT firmware or None """
+        name = fwtype.split('_')[0]
+        kinds = FIRMWARE_KINDS_OF_TYPE.get(name, ())
+        found = [(kinds.index(entry['kind']), path)
+                 for path, entry in self.entries.items()
+                 if entry['version'] == version and entry['kind'] in kinds]
+        if found:
+            return min(found)[1], None
+        if name in ('linux', 'rootfs'):
+            for path, entry in sorted(self.entries.items()):
+                if entry['version'] == version and entry['kind'] == 'miot':
+                    return path, name
+        return None, None
+
+    def save(self):
+        """ write the manifest atomically """
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(self.path),
+                    delete=False) as f_out:
+                json.dump(self.entries, f_out)
+            os.replace(f_out.name, self.path)
+        except OSError:
+            pass
+
+
+_catalog = None
+
+
+def get_catalog():
+    """ the catalog of this process """
+    global _catalog  # pylint: disable=global-statement
+    if _catalog is None:
+        _catalog = Catalog()
+    return _catalog
+
+
+class Phase:
+    """ a running phase of a flow, see Telemetry.phase() """
+
+    def __init__(self, telemetry, name, size=0):
+        self.telemetry = telemetry
+        self.name = name
+        self.size = size
+        self.start = time.monotonic()
+
+    def done(self, ok=True, size=None):
+        """ emit the event of the phase, size overrides the byte count """
+        self.telemetry.end_phase(self, ok, self.size if size is None
+                                 else size)
+        return ok
+
+
+class Telemetry:
+    """ JSON-lines events of the flows of a run and their phases
+
+        Every event has the monotonic ts and the wall time. A phase event
+        has its flow, seconds, bytes and throughput, and the port when
+        the thread set local.port in station mode. Phases still open
+        when their flow ends are emitted as failed, a flow fails when it
+        returns False or any of its phases failed. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.run_id = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                     os.getpid())
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def flows(self):
+        """ flow names of the current thread, innermost last """
+        if not hasattr(self.local, 'flows'):
+            self.local.flows = []
+        return self.local.flows
+
+    @property
+    def failures(self):
+        """ count of the failed phases of the current thread """
+        return getattr(self.local, 'failures', 0)
+
+    @property
+    def open(self):
+        """ phases of the current thread which are not done """
+        if not hasattr(self.local, 'open'):
+            self.local.open = []
+        return self.local.open
+
+    def emit(self, event, **fields):
+        """ record an event and append it to the events file """
+        record = {'ts': round(time.monotonic(), 6),
+                  'time': round(time.time(), 3),
+                  'run': self.run_id, 'event': event}
+        if getattr(self.local, 'port', None):
+            record['port'] = self.local.port
+        record.update(fields)
+        with self.lock:
+            self.events.append(record)
+            if self.path:
+                try:
+                    with open(self.path, 'a') as f_out:
+                        f_out.write(json.dumps(record) + '\n')
+                except OSError:
+                    pass
+        return record
+
+    def phase(self, name, size=0):
+        """ start a phase of the current flow, call done() on it """
+        phase = Phase(self, name, size)
+        self.open.append(phase)
+        return phase
+
+    def end_phase(self, phase, ok, size):
+        """ emit a phase event, see Phase.done() """
+        if phase not in self.open:
+            return
+        self.open.remove(phase)
+        if not ok:
+            self.local.failures = self.failures + 1
+        seconds = time.monotonic() - phase.start
+        self.emit('phase', flow=self.flows[-1] if self.flows else None,
+                  phase=phase.name, seconds=round(seconds, 6), bytes=size,
+                  mb_s=round(size / seconds / 1e6, 3) if size and seconds
+                  else None,
+                  ok=bool(ok))
+
+    def flow(self, name):
+        """ decorator emitting a flow event around a burn function, the
+            flow is ok if it returns a true value and no phase failed """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                self.flows.append(name)
+                opened = len(self.open)
+                failures = self.failures
+                start = time.monotonic()
+                result = False
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    for phase in self.open[opened:]:
+                        phase.done(ok=False)
+                    self.emit('flow', flow=name,
+                              seconds=round(time.monotonic() - start, 6),
+                              ok=bool(result) and
+                              self.failures == failures)
+                    self.flows.pop()
+                return result
+            return wrapper
+        return decorator
+
+    def totals(self):
+        """ {(flow, phase): [count, seconds, bytes, failed]} """
+        totals = collections.OrderedDict()
+        for event in self.events:
+            if event['event'] != 'phase':
+                continue
+            total = totals.setdefault((event['flow'], event['phase']),
+                                      [0, 0.0, 0, 0])
+            total[0] = total[0] + 1
+            total[1] = total[1] + event['seconds']
+            total[2] = total[2] + event['bytes']
+            total[3] = total[3] + (0 if event['ok'] else 1)
+        return totals
+
+    def summary(self):
+        """ print the table of the phases of this run """
+        totals = self.totals()
+        if not totals:
+            return
+        print("{:<10} {:<10} {:>5} {:>9} {:>11} {:>8} {:>6}".format(
+            'flow', 'phase', 'count', 'seconds', 'bytes', 'KB/s', 'failed'))
+        for (flow, phase), (count, seconds, size, failed) in totals.items():
+            print("{:<10} {:<10} {:>5} {:>9.2f} {:>11} {:>8} {:>6}".format(
+                flow or '-', phase, count, seconds, size,
+                '{:.1f}'.format(size / seconds / 1e3)
+                if size and seconds else '-', failed))
+
+    def write_prometheus(self, path):
+        """ write the totals of this run as a Prometheus textfile """
+        metrics = (
+            ('phase_seconds', 'Seconds spent in the phase', 1),
+            ('phase_bytes', 'Bytes transferred in the phase', 2),
+            ('phase_count', 'Count of the phase', 0),
+            ('phase_failures', 'Failed count of the phase', 3))
+        lines = []
+        totals = self.totals()
+        for name, help_text, index in metrics:
+            lines.append('# HELP gateway3utils_{} {} in the last run'.format(
+                name, help_text))
+            lines.append('# TYPE gateway3utils_{} gauge'.format(name))
+            for (flow, phase), total in totals.items():
+                lines.append(
+                    'gateway3utils_{}{{flow="{}",phase="{}"}} {}'.format(
+                        name, flow or '', phase, total[index]))
+        # a flow may run many times, e.g. per port or per section, and
+        # each series must be written once
+        flows = collections.OrderedDict()
+        for event in self.events:
+            if event['event'] == 'flow':
+                total = flows.setdefault(event['flow'], [0, 0])
+                total[0] = total[0] + 1
+                total[1] = total[1] + (0 if event['ok'] else 1)
+        metrics = (
+            ('flow_count', 'Count of the flow', 0),
+            ('flow_failures', 'Failed count of the flow', 1))
+        for name, help_text, index in metrics:
+            lines.append('# HELP gateway3utils_{} {} in the last run'.format(
+                name, help_text))
+            lines.append('# TYPE gateway3utils_{} gauge'.format(name))
+            for flow, total in flows.items():
+                lines.append('gateway3utils_{}{{flow="{}"}} {}'.format(
+                    name, flow, total[index]))
+        lines.append('# HELP gateway3utils_flow_success '
+                     'Whether every run of the flow succeeded in the last run')
+        lines.append('# TYPE gateway3utils_flow_success gauge')
+        for flow, total in flows.items():
+            lines.append('gateway3utils_flow_success{{flow="{}"}} {}'.format(
+                flow, int(not total[1])))
+        lines.append('# HELP gateway3utils_last_run_timestamp_seconds '
+                     'Wall time of the end of the last run')
+        lines.append('# TYPE gateway3utils_last_run_timestamp_seconds gauge')
+        lines.append('gateway3utils_last_run_timestamp_seconds {:.3f}'.format(
+            time.time()))
+        try:
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=os.path.dirname(os.path.abspath(path)),
+                    delete=False) as f_out:
+                f_out.write('\n'.join(lines) + '\n')
+            os.replace(f_out.name, path)
+        except OSError:
+            print("Write {} Error!".format(path))
+
+
+telemetry = Telemetry()
+
+
+def report_telemetry(prom=None):
+    """ print the phase summary of the run, write it to prom if set """
+    telemetry.summary()
+    if prom:
+        telemetry.write_prometheus(prom)
+
+
+SERIAL_RING_SIZE = 0x100000
+
+
+class SerialConsole:
+    """ serial port read by a background thread into a ring buffer
+
+        Every byte received is appended to the capture file of the
+        session, including the bytes dropped by clear(). """
+
+    def __init__(self, port, baudrate, timeout=10, capture=None):
+        _import_serial_modules()
+        self.serial = serial.Serial(port, baudrate, timeout=.1)
+        self.port = port
+        self.timeout = timeout
+        self.capture = None
+        if capture is not None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(capture)),
+                            exist_ok=True)
+                self.capture = open(capture, 'ab')
+                self.capture.write('\n--- {} {} baud {} ---\n'.format(
+                    port, baudrate, time.strftime('%Y-%m-%d %H:%M:%S')
+                ).encode())
+            except OSError:
+                self.capture = None
+        self._buf = bytearray()
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+
+    def _reader(self):
+        while self._running:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except (OSError, serial.serialutil.SerialException) as err:
+                with self._cond:
+                    self._error = err
+                    self._cond.notify_all()
+                return
+            if not data:
+                continue
+            if self.capture is not None:
+                self.capture.write(data)
+            with self._cond:
+                self._last = time.monotonic()
+                self._buf.extend(data)
+                if len(self._buf) > SERIAL_RING_SIZE:
+                    del self._buf[:len(self._buf) - SERIAL_RING_SIZE]
+                self._cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        """ count of buffered bytes """
+        return len(self._buf)
+
+    def _wait(self, ready, timeout):
+        """ wait until ready() returns not None, the result or None """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                result = ready()
+                if result is not None:
+                    return result
+                remaining = deadline - time.monotonic()
+                if self._error is not None or remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def expect(self, pattern, timeout=None):
+        """ wait for pattern (bytes, list of bytes or compiled regex),
+            consume and return the bytes up to the end of the match,
+            None on timeout """
+        if isinstance(pattern, bytes):
+            pattern = [pattern]
+        if isinstance(pattern, (list, tuple)):
+            pattern = re.compile(b'|'.join(re.escape(p) for p in pattern))
+
+        def ready():
+            match = pattern.search(self._buf)
+            if match is None:
+                return None
+            data = bytes(self._buf[:match.end()])
+            del self._buf[:match.end()]
+            return data
+        return self._wait(ready, timeout)
+
+    def quiet(self, idle=.1, timeout=None):
+        """ wait until nothing is received for idle seconds,
+            False on timeout """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now - self._last >= idle:
+                    return True
+                if self._error is not None or now >= deadline:
+                    return False
+                self._cond.wait(min(idle - (now - self._last),
+                                    deadline - now))
+
+    def read(self, size=1, timeout=None):
+        """ read up to size bytes, wait for the first one """
+        def ready():
+            if not self._buf:
+                return None
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+            return data
+        return self._wait(ready, timeout) or b''
+
+    def read_until(self, expected=b'\n', timeout=None):
+        """ like serial.Serial.read_until, the buffered bytes on timeout """
+        data = self.expect(expected, timeout)
+        if data is None:
+            data = self.read(len(self._buf) or 1, 0)
+        return data
+
+    def write(self, data):
+        """ write data to the port """
+        return self.serial.write(data)
+
+    def flush(self):
+        """ wait until all data is written """
+        self.serial.flush()
+
+    def clear(self):
+        """ drop the buffered bytes, they are kept in the capture """
+        with self._cond:
+            self._buf.clear()
+
+    def close(self):
+        """ stop the reader and close the port """
+        self._running = False
+        self._thread.join()
+        self.serial.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+
+def _port_name(port):
+    """ file name suffix of a serial port, e.g. _ttyUSB0 """
+    name = re.sub(r'[^\w.-]', '_', os.path.basename(port or ''))
+    return '_{}'.format(name) if name else ''
+
+
+def open_console(params, baudrate, timeout=10):
+    """ SerialConsole of params['comport'] capturing to params['capture'],
+        None if the port cannot be opened """
+    try:
+        return SerialConsole(params['comport'], baudrate, timeout,
+                             params.get('capture'))
+    except (OSError, serial.serialutil.SerialException):
+        print("Open COM Port ({}) Error!".format(params['comport']))
+        return None
 
 
 def clear_serial_buffer(console):
     """ clear the buffer of serail """
-    if console.in_waiting:
-        console.read(console.in_waiting)
-    console.reset_input_buffer()
-    console.reset_output_buffer()
+    console.clear()
     console.flush()
 
 
-def wait_for_realtek_cli(console):
-    """ wait cli of <RealTek> """
-    data = str(console.read_until(), encoding="utf-8")
-    while "<RealTek>" not in data:
-        data = str(console.read_until(), encoding="utf-8")
+def wait_for_realtek_cli(console, timeout=30):
+    """ wait cli of <RealTek>, False on timeout """
+    if console.expect(b'<RealTek>', timeout) is None:
+        print("No <RealTek> prompt in {}s!".format(timeout))
+        return False
+    return True
+
+
+class SerialState(collections.namedtuple(
+        'SerialState', 'name send expect timeout retries fail')):
+    """ a state of a serial flow: the input is dropped, send is written
+        and one of the expect patterns must follow within timeout
+        seconds, else send is written again. A fail pattern ends the flow.
+        With expect None the state ends once the line is quiet for
+        timeout seconds. """
+
+    def __new__(cls, name, send, expect, timeout, retries=1, fail=()):
+        return super().__new__(cls, name, send, expect, timeout, retries,
+                               fail)
+
+
+PROMPT = b'<RealTek>'
+
+# a run of u while the gateway boots stops it in the rom console, the u
+# queued meanwhile are answered before the line is quiet again
+BOOTROM_STATES = (
+    SerialState('break_in', b'u', (b'Enter ROM console', PROMPT), .05,
+                2400, (b'rlxlinux login', b'Linux version')),
+    SerialState('settle', None, None, .2, 25),
+    SerialState('prompt', b'\n', (PROMPT,), 1, 3),
+    SerialState('dbgmsg', b'dbgmsg 3\n', (PROMPT,), 3, 3),
+    SerialState('ri', b'ri 0 1 1\n', (PROMPT,), 30),
+    SerialState('settle', None, None, .2, 25),
+)
+
+# the flasher answers at its baud rate once it is booted
+FLASHER_STATES = (
+    SerialState('flasher', b'\n', (PROMPT,), .2, 50),
+    SerialState('settle', None, None, .1, 10),
+)
+
+
+def _receive_state(command):
+    """ state of an xmrx/xmod command, it ends when the console has
+        echoed the command line, the receiver asks for packets next """
+    echo = command.strip().encode()
+    return SerialState(command.split()[0], command.encode(),
+                       (echo + b'\r\n', echo + b'\n'), 3, 1)
+
+
+def run_serial_states(console, states, debug=False):
+    """ run states in order, return the output of the last state or None
+        when a state fails """
+    data = None
+    for state in states:
+        start = time.monotonic()
+        console.clear()
+        for _ in range(state.retries):
+            if state.expect is None:
+                data = b'' if console.quiet(state.timeout,
+                                            state.timeout * 10) else None
+                console.clear()
+            else:
+                if state.send:
+                    console.write(state.send)
+                    console.flush()
+                data = console.expect(
+                    list(state.expect) + list(state.fail), state.timeout)
+            if data is not None:
+                break
+        else:
+            print("No answer to {} in {:.1f}s!".format(
+                state.name, time.monotonic() - start))
+            return None
+        if any(data.endswith(pattern) for pattern in state.fail):
+            print("Unexpected {} in {}!".format(
+                data.decode(errors='replace').split('\n')[-1],
+                state.name))
+            return None
+        if debug:
+            print("{} {:.3f}s".format(state.name, time.monotonic() - start))
+    return data
 
 
 def _enter_bootrom_console_and_get_ready(console, debug=False):
@@ -391,39 +1526,8 @@ def _enter_bootrom_console_and_get_ready(console, debug=False):
     print("If your gateway3 is powered up,"
           " disconnect usb cable and reconnect it.")
 
-    data = ""
-    console.write(b"u")
-    while "Enter ROM console" not in data:
-        console.write(b"u")
-        console.flush()
-        time.sleep(.05)
-        try:
-            if console.in_waiting:
-                data = str(console.read_until(), encoding="utf-8")
-        except UnicodeDecodeError:
-            pass
-        except OSError:
-            return False
-        if debug and console.in_waiting:
-            print(data)
-        if "rlxlinux login" in data or "Linux version" in data:
-            return False
-        if "<RealTek>" in data:
-            break
-    console.write(b"\n")
-
-    time.sleep(1)
-    if console.in_waiting:
-        console.read(console.in_waiting)
-
-    console.write(b"\n")
-    time.sleep(1)
-    console.write(b"dbgmsg 3\n")
-    console.write(b"ri 0 1 1\n")
-
-    wait_for_realtek_cli(console)
-    time.sleep(3)
-    clear_serial_buffer(console)
+    if run_serial_states(console, BOOTROM_STATES, debug) is None:
+        return False
     if debug:
         print("Enter bootrom cli!")
     return True
@@ -431,6 +1535,10 @@ def _enter_bootrom_console_and_get_ready(console, debug=False):
 
 def _check_comport_exist(comport):
     """ check_comport_exist """
+    if comport.startswith('/dev/pts/') and os.path.exists(comport):
+        # pseudo-terminals like the one of fake_bootrom.py are not listed
+        return True
+    _import_serial_modules()
     comports = list_ports.comports()
     comport_exist = False
     for port in comports:
@@ -443,54 +1551,247 @@ def _check_comport_exist(comport):
     return True
 
 
-def _generate_padded_firmware(fwfile):
-    """ prepare padded firmware """
-    fwsize = os.stat(fwfile).st_size
+def _read_firmware(params):
+    """ view of the firmware without cr6c/r6cr header """
+    data = params.get('fwdata')
+    if data is None:
+        data = _map_file(params['fwfile'])
+    if data[:4] == b'cr6c' or data[:4] == b'r6cr':
+        data = data[16:]
+    return data
 
-    # RAW filename including inverted checksum bytes.
-    # The return value is zero.
-    if calc_checksum_of_firmware(fwfile) >= 1:
-        print("The raw firmware is invaild format.")
-        return False
 
-    pad_number = 0x20000 - (fwsize % 0x20000) if fwsize % 0x20000 >= 1 else 0
+class PaddedImage(io.RawIOBase):
+    """ read-only stream of data followed by 0xff up to the next erase
+        block, no bytes are copied until they are read """
+
+    def __init__(self, data, align=ERASE_BLOCK_SIZE):
+        super().__init__()
+        self.data = memoryview(data)
+        self.size = len(self.data) + (-len(self.data) % align)
+        self.align = align
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
 
-    with open(fwfile, 'rb') as fw_flie:
-        data = fw_flie.read()
-    with open("{}_padding".format(fwfile), 'wb') as fw_flie:
-        padding = [0xff for _ in range(pad_number)]
-        fw_flie.write(data)
-        fw_flie.write(bytearray(padding))
+    def readinto(self, buf):
+        buf = memoryview(buf).cast('B')
+        size = max(0, min(len(buf), self.size - self._pos))
+        data_size = max(0, min(size, len(self.data) - self._pos))
+        buf[:data_size] = self.data[self._pos:self._pos + data_size]
+        buf[data_size:size] = b'\xff' * (size - data_size)
+        self._pos = self._pos + size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self._pos + offset
+        elif whence == io.SEEK_END:
+            offset = self.size + offset
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def reopen(self):
+        """ new stream over the same data """
+        return PaddedImage(self.data, self.align)
+
+
+def _content_digest(params):
+    """ sha256 of the firmware of params, a file is only read if it is
+        not in the sum cache or changed """
+    if params.get('fwdata') is None:
+        return get_sum_cache().digest(params['fwfile'])
+    return hashlib.sha256(params['fwdata']).hexdigest()
+
+
+def prepare_firmware(params):
+    """ meta of the firmware of params without its cr6c/r6cr header:
+        sha256, raw_size, padded_size, sum and checksum, computed once
+        per content and then read from the artifact cache """
+    digest = _content_digest(params)
+    key = digest[:32]
+    entry = get_artifact_cache().get(key)
+    if entry is not None:
+        return entry['meta']
+    raw = _read_firmware(params)
+    words_sum = WordSum()
+    words_sum.update(raw)
+    meta = {'sha256': digest, 'raw_size': len(raw),
+            'padded_size': PaddedImage(raw).size, 'sum': words_sum.sum,
+            'checksum': words_sum.checksum}
+    return get_artifact_cache().put(key, meta)['meta']
+
+
+def prepare_artifacts(params):
+    """ fill the artifact cache with the firmware of params: its meta,
+        the fw_update image of linux/rootfs and the gzip with --gzip """
+    if params.get('fwdata') is None and not os.path.isfile(params['fwfile']):
+        print("The {} is not exist!".format(params['fwfile']))
+        return False
+    meta = prepare_firmware(params)
+    print("sha256 {sha256:.16}... raw {raw_size} padded {padded_size} "
+          "sum {sum:#06x} checksum {checksum:#06x}".format(**meta))
+    source = params['fwdata']
+    if source is None:
+        source = params['fwfile']
+        entry = get_catalog().lookup(params['fwfile'])
+        if entry is not None and entry['kind'] in ('hsqs', 'linux_raw') \
+                and params['fwtype'] in MTD_PARTITIONS:
+            source = _prepare_firmware(params['fwfile'], params['fwtype'])
+            if source is None:
+                return False
+            print("fw_update {}".format(source))
+    if params.get('gzip'):
+        print("gzip {}".format(_gzip_firmware(source)[0]))
+    cache = get_artifact_cache()
+    print("{} artifacts, {} of {} MB in {}".format(
+        len(cache.entries), cache.total_size() >> 20,
+        cache.max_size >> 20, cache.path))
     return True
 
 
+def _padded_firmware(params, raw):
+    """ PaddedImage of raw, a new stream of params['image'] if the image
+        was prepared once for many ports """
+    if params.get('image') is not None:
+        return params['image'].reopen()
+    if prepare_firmware(params)['checksum'] >= 1:
+        print("The raw firmware is invaild format.")
+        return None
+    return PaddedImage(raw)
+
+
+def _firmware_sum(params, raw):
+    """ sum of raw for boot_info, params['fwsum'] if it is prepared """
+    # pylint: disable=unused-argument
+    if params.get('fwsum') is not None:
+        return params['fwsum']
+    nsum = _known_firmware_sum(params['fwfile'])
+    if nsum is None:
+        nsum = prepare_firmware(params)['sum']
+    return hex(nsum & 0xFFFF)
+
+
+# (100MHz >> 4) / baud rate
+# baud rate (speed)     =   38400   |  115200   |  230400   |   460800
+# error rate            = 0.0046875 | 0.0046875 | 0.0046918 | 0.04333550
+FLASHER_BAUDRATES = (38400, 115200, 230400, 460800)
+FLASHER_BAUDRATE = 230400
+
+
+def _probe_baudrate(comport, baudrate, rounds=3, timeout=.5,
+                    capture=None):
+    """ round-trip test of the flasher cli at baudrate,
+        return the measured throughput in bytes/s or None """
+    prompt = b'<RealTek>'
+    try:
+        console = SerialConsole(comport, baudrate, timeout, capture)
+    except (OSError, serial.serialutil.SerialException):
+        return None
+    try:
+        clear_serial_buffer(console)
+        for _ in range(rounds):
+            console.write(b'\n')
+            if console.expect(prompt) is None:
+                return None
+        start = time.monotonic()
+        console.write(b'DB 0xa0000000 1024\n')
+        data = console.expect(prompt)
+        elapsed = time.monotonic() - start
+        if data is None or b'A0000000' not in data.upper():
+            return None
+        return len(data) / elapsed
+    finally:
+        console.close()
+
+
+def _load_baudrates():
+    """ saved flasher baud rates, {flasher sha256: {port: entry}} """
+    try:
+        with open(os.path.join(CACHE_DIR, 'baudrates.json'), 'r') as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return {}
+
+
+def saved_flasher_baudrate(comport, flasher):
+    """ baud rate detected before for the flasher file on comport """
+    port = _load_baudrates().get(
+        get_sum_cache().digest(flasher), {}).get(comport)
+    return None if port is None else port['baudrate']
+
+
+def detect_flasher_baudrate(comport, flasher, reprobe=False,
+                            capture=None):
+    """ the baud rate which the running flasher answers at
+
+        The flasher is built for one baud rate, this detects it and does
+        not change it. The rate and its measured throughput are saved by
+        the sha256 of the flasher file and the port, so later runs only
+        check the saved rate once instead of probing all of them. """
+    saved = _load_baudrates()
+    digest = get_sum_cache().digest(flasher)
+    port = saved.get(digest, {}).get(comport)
+    if (port is not None and not reprobe and
+            _probe_baudrate(comport, port['baudrate'], rounds=1,
+                            capture=capture)):
+        return port['baudrate']
+
+    # the default rate of the flasher first, the others only if it fails
+    for baudrate in sorted(FLASHER_BAUDRATES,
+                           key=lambda rate: rate != FLASHER_BAUDRATE):
+        rate = _probe_baudrate(comport, baudrate, capture=capture)
+        print("Probe {} baud: {}".format(
+            baudrate, 'no response' if rate is None else
+            '{:.0f} bytes/s'.format(rate)))
+        if rate is not None:
+            break
+    else:
+        return None
+    saved.setdefault(digest, {})[comport] = {
+        'baudrate': baudrate, 'throughput': rate}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, 'baudrates.json'), 'w') as f_out:
+            json.dump(saved, f_out)
+    except OSError:
+        pass
+    return baudrate
+
+
 def _bootrom_download_flasher(params, console, in_flasher):
     # pylint: disable=unused-argument
-    # (100MHz >> 4) / baud rate
-    # baud rate (speed)     =   38400   |  115200   |  230400   |   460800
-    # error rate            = 0.0046875 | 0.0046875 | 0.0046918 | 0.04333550
-    flasher_baudrate = 230400
     # PyInstaller creates a temp folder and stores path in _MEIPASS
     base_path = getattr(sys, '_MEIPASS', os.getcwd())
+    flasher = "{}/flasher.bin".format(base_path)
+    flasher_baudrate = params.get('flasher_baudrate')
+    if flasher_baudrate is None and params.get('detect_baudrate'):
+        flasher_baudrate = saved_flasher_baudrate(params['comport'],
+                                                  flasher)
+    flasher_baudrate = flasher_baudrate or FLASHER_BAUDRATE
 
-    try:
-        if not in_flasher:
-            data = params['baudrate']
-        else:
-            data = flasher_baudrate
-        console = serial.Serial(params['comport'], data, timeout=10)
-    except serial.serialutil.SerialException:
-        print("Open COM Port ({}) Error!".format(params['comport']))
-        os.remove("{}_padding".format(params['fwfile']))
+    if not in_flasher:
+        data = params['baudrate']
+    else:
+        data = flasher_baudrate
+    console = open_console(params, data)
+    if console is None:
         return None
 
     def getc(size, timeout=1):
-        return console.read(size)
+        return console.read(size, timeout)
 
     def putc(data, timeout=1):
         return console.write(data)
 
-    fwsize = os.stat("{}/flasher.bin".format(base_path)).st_size
+    fwsize = os.stat(flasher).st_size
 
     if 'pyprind' in sys.modules:
         def putc_user(data, timeout=1):
@@ -504,36 +1805,61 @@ def _bootrom_download_flasher(params, console, in_flasher):
         modem = XMODEM(getc, putc)
 
     if not in_flasher:
-        if not _enter_bootrom_console_and_get_ready(console, params['debug']):
+        phase = telemetry.phase('bootrom')
+        if not phase.done(_enter_bootrom_console_and_get_ready(
+                console, params['debug'])):
             print("The gateway is not ready for download!")
+            console.close()
             return None
 
         print("Downloading the flasher.")
-        console.write("xmrx 0xa0000000\n".encode())
-        time.sleep(1)
+        phase = telemetry.phase('flasher', fwsize)
+        if run_serial_states(console, [_receive_state("xmrx 0xa0000000\n")],
+                             params['debug']) is None:
+            console.close()
+            return None
 
-        clear_serial_buffer(console)
         if sys.platform == 'darwin':
             console.close()
             time.sleep(1)
-            console = serial.Serial(params['comport'],
-                                    params['baudrate'],
-                                    timeout=10)
+            console = open_console(params, params['baudrate'])
+            if console is None:
+                return None
 
-        with open("{}/flasher.bin".format(base_path), 'rb') as f_in:
-            modem.send(f_in)
+        with open(flasher, 'rb') as f_in:
+            sent = modem.send(f_in)
 
         console.write("j a0000000\n".encode())
+        phase.done(sent)
 
         console.close()
-        bar_user.update(force_flush=True)
-        bar_user.stop()
-
-        time.sleep(3)  # wait flasher boot up
+        if 'pyprind' in sys.modules:
+            bar_user.update(force_flush=True)
+            bar_user.stop()
 
-        console = serial.Serial(params['comport'],
-                                flasher_baudrate,
-                                timeout=3)
+        console = open_console(params, flasher_baudrate, timeout=3)
+        if console is None:
+            return None
+        data = run_serial_states(console, FLASHER_STATES, params['debug'])
+        if data is None and params.get('detect_baudrate'):
+            # the flasher runs at another rate than the expected one
+            console.close()
+            phase = telemetry.phase('detect')
+            data = detect_flasher_baudrate(
+                params['comport'], flasher, reprobe=True,
+                capture=params.get('capture'))
+            if not phase.done(data is not None):
+                print("The flasher does not answer at any baud rate!")
+                return None
+            print("Use {} baud for the flasher.".format(data))
+            flasher_baudrate = params['flasher_baudrate'] = data
+            console = open_console(params, flasher_baudrate, timeout=3)
+            if console is None:
+                return None
+        elif data is None:
+            print("The flasher does not boot up!")
+            console.close()
+            return None
 
     return console
 
@@ -546,86 +1872,325 @@ def _update_boot_info(console, fw_type, new_sum, new_size):
         new_size, new_sum)
     console.write(command.encode())
 
-    wait_for_realtek_cli(console)
+    if not wait_for_realtek_cli(console):
+        return False
 
     command = "boot_ctrl set_{}newest {}\n".format(
         fw_type[:-1], fw_type[-1:])
     console.write(command.encode())
+    return wait_for_realtek_cli(console)
+
+
+UART_CHUNK_SIZE = 0x2000
+
+
+def _build_uart_commands(image, ddr_base, offset):
+    """ eb and NANDW commands writing the stream image to flash at offset,
+        return a list of (command, is_barrier) """
+    commands = []
+    ddr_base = int(ddr_base, 0)
+    offset = int(offset, 0)
+    chunk = 0
+    raw = image.read(UART_CHUNK_SIZE)
+    while raw:
+        for i in range(0, len(raw), 16):
+            data = " ".join("{:02x}".format(c) for c in raw[i:i+16])
+            commands.append(("eb {} {}\n".format(
+                hex(ddr_base + i), data).encode(), False))
+        commands.append(('NANDW {} {} {}\ny\n'.format(
+            hex(offset + chunk), hex(ddr_base),
+            hex(len(raw))).encode(), True))
+        chunk = chunk + len(raw)
+        raw = image.read(UART_CHUNK_SIZE)
+    return commands
+
+
+def _send_commands_pipelined(console, commands, window=4, timeout=10,
+                             progress=None):
+    """ send commands while at most window of them wait for the <RealTek>
+        prompt, a barrier command is sent alone.
+        return the count of acknowledged commands """
+    prompt = b'<RealTek>'
+    index = 0
+    pending = 0
+    acked = 0
+    blocked = False
+    while acked < len(commands):
+        while not blocked and index < len(commands) and pending < window:
+            command, barrier = commands[index]
+            if barrier and pending:
+                break
+            console.write(command)
+            index = index + 1
+            pending = pending + 1
+            blocked = barrier
+        if console.expect(prompt, timeout) is None:
+            break
+        pending = pending - 1
+        acked = acked + 1
+        if not pending:
+            blocked = False
+        if progress is not None:
+            progress(acked, len(commands))
+    return acked
 
 
+@telemetry.flow('uart')
 def burn_by_uart(params, in_flasher=False):
     """ burn by uart command """
     console = None
 
-    with open(params['fwfile'], 'rb') as f_in:
-        raw = f_in.read(16)
-        if raw[:4] == b'cr6c' or raw[:4] == b'r6cr':
-            with open("{}_raw".format(params['fwfile']), 'wb') as f_out:
-                f_out.write(f_in.read())
-            params['fwfile'] = "{}_raw".format(params['fwfile'])
+    image = _padded_firmware(params, _read_firmware(params))
+    if image is None:
+        print("Generate padded firmware Failed!")
+        return False
+
+    console = _bootrom_download_flasher(params, console, in_flasher)
+
+    if console is None:
+        print("Goto flasher failed, try again.")
+        return False
+
+    console.write(b'\n')
+
+    if not wait_for_realtek_cli(console):
+        console.close()
+        return False
+
+    commands = _build_uart_commands(image, params['ddr_base'],
+                                    params['offset'])
+
+    def progress(acked, total):
+        sys.stdout.write("Download progress: %d%%   \r" % (
+            acked * 100 / total))
+        sys.stdout.flush()
+
+    start = time.monotonic()
+    phase = telemetry.phase('uart', image.size)
+    acked = _send_commands_pipelined(console, commands, progress=progress)
+    elapsed = time.monotonic() - start
+    phase.done(acked == len(commands))
+    console.close()
+    # the fixed sleeps were 0.1s per eb and 1s per NANDW
+    nandw = sum(1 for _, barrier in commands if barrier)
+    print("Transfer took {:.1f}s, {:.1f}s with fixed sleeps.".format(
+        elapsed, (len(commands) - nandw) * .1 + nandw))
+    if acked < len(commands):
+        print("No response of gateway at command {} of {}!".format(
+            acked + 1, len(commands)))
+        return False
+    print("Program flash Done!")
+    return True
+
+
+@telemetry.flow('xmodem')
+def burn_by_xmodem(params, in_flasher=False):
+    # pylint: disable=unused-argument
+    """ burn by xmodem """
+    console = None
 
-    if not _generate_padded_firmware(params['fwfile']):
+    raw = _read_firmware(params)
+    image = _padded_firmware(params, raw)
+    if image is None:
         print("Generate padded firmware Failed!")
-        return
+        return False
 
     console = _bootrom_download_flasher(params, console, in_flasher)
 
-    if console is None:
-        print("Goto flasher failed, try again.")
-        return
+    if console is None:
+        print("Goto flasher failed, try again.")
+        return False
+
+    console.write(b'\n\n')
+
+    if not wait_for_realtek_cli(console):
+        console.close()
+        return False
+
+    command = "xmod {}\n".format(params['ddr_base'])
+    if run_serial_states(console, [_receive_state(command)],
+                         params['debug']) is None:
+        console.close()
+        return False
+
+    print("Now transmitting {}".format(params['fwfile']))
+    fwsize = image.size
+
+    def getc(size, timeout=1):
+        return console.read(size, timeout)
+
+    def putc(data, timeout=1):
+        return console.write(data)
+
+    if 'pyprind' in sys.modules:
+        def putc_user(data, timeout=1):
+            bar_user.update()
+            return console.write(data)
+
+        bar_user = pyprind.ProgBar(fwsize/1024 - 1, width=60)
+        modem = XMODEM1k(getc, putc_user)
+    else:
+        modem = XMODEM1k(getc, putc)
+
+    phase = telemetry.phase('xmod', fwsize)
+    modem.send(image)
+
+    data = console.expect(b'<RealTek>')
+    if not phase.done(data is not None and b"Rx len=" in data):
+        print("Transmit Error!")
+        console.close()
+        return False
+
+    print("Transmit Done! Please wait for programming to flash.")
+
+    command = 'NANDW {} {} {}\n'.format(
+        hex(int(params['offset'], 0)), params['ddr_base'], hex(fwsize))
+    phase = telemetry.phase('nandw', fwsize)
+    console.write(command.encode())
+    console.write(b'y\n')
+    if not phase.done(wait_for_realtek_cli(console, timeout=120)):
+        console.close()
+        return False
+
+    sum_firmware = _firmware_sum(params, raw)
+    phase = telemetry.phase('boot_ctrl')
+    if not phase.done(_update_boot_info(console, params['fwtype'],
+                                        sum_firmware, fwsize)):
+        print("Update boot_info Error!")
+        console.close()
+        return False
+
+    console.close()
+    print("Programming {} Done!".format(params['fwfile']))
+    return True
+
+
+def _load_base(params):
+    """ view of the base image for delta flashing, params['base'] is a
+        file (a firmware or a backup of the slot) or a catalog version """
+    base = params.get('base')
+    if not base:
+        return None
+    if os.path.isfile(base):
+        return _read_firmware({'fwfile': base})
+    path, section = get_catalog().find(base, params['fwtype'])
+    if path is None:
+        print("The {} of {} is not in the catalog!".format(
+            params['fwtype'], base))
+        return None
+    if section is not None:
+        return _read_firmware(
+            {'fwdata': _extract_firmwares(path).section_data(section)})
+    return _read_firmware({'fwfile': path})
+
+
+def _delta_blocks(image, base):
+    """ erase blocks of the padded image which differ from base """
+    blocks = []
+    image.seek(0)
+    for block in range(image.size // ERASE_BLOCK_SIZE):
+        start = block * ERASE_BLOCK_SIZE
+        data = image.read(ERASE_BLOCK_SIZE)
+        old = base[start:start + ERASE_BLOCK_SIZE]
+        if len(old) < len(data):
+            old = bytes(old) + b'\xff' * (len(data) - len(old))
+        if data != old:
+            blocks.append(block)
+    image.seek(0)
+    return blocks
+
+
+# a journal older than this is not resumed
+JOURNAL_MAX_AGE = 24 * 3600
+# a NANDW answer with one of them (in lower case) is a failure
+NANDW_ERRORS = (b'fail', b'error', b'abort', b'bad block', b'unknown')
+
+
+class BurnJournal:
+    """ erase blocks already committed to flash for an image and offset
+        through a port, kept on disk so an interrupted burn can be
+        resumed on the same unit
+
+        unit identifies the gateway (a hash of its factory partition),
+        the journal of another unit or older than JOURNAL_MAX_AGE is
+        dropped. """
+
+    def __init__(self, data, offset, port='', unit=None):
+        digest = hashlib.sha256(data).hexdigest()
+        self.path = os.path.join(CACHE_DIR, 'journal', '{}_{}{}.json'.format(
+            digest[:16], offset, _port_name(port)))
+        self.unit = unit
+        self.committed = set()
+        self.time = time.time()
+        try:
+            with open(self.path, 'r') as f_in:
+                saved = json.load(f_in)
+        except (OSError, ValueError):
+            return
+        if saved.get('unit') != unit or unit is None:
+            print("Drop the journal {} of another or an unknown "
+                  "unit.".format(self.path))
+        elif self.time - saved.get('time', 0) > JOURNAL_MAX_AGE:
+            print("Drop the journal {} from {}.".format(
+                self.path, time.ctime(saved.get('time', 0))))
+        else:
+            self.committed = set(saved.get('committed', []))
+            self.time = saved['time']
+
+    def commit(self, block):
+        """ mark block as written """
+        self.committed.add(block)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f_out:
+                json.dump({'committed': sorted(self.committed),
+                           'unit': self.unit, 'time': self.time}, f_out)
+        except OSError:
+            pass
+
+    def done(self):
+        """ remove the journal when the whole image is written """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 
-    console.write(b'\n')
+def _unit_id(console, ddr_base, retry=3):
+    """ hash of the factory partition of the gateway in the flasher,
+        None if it can not be read """
+    for _ in range(retry):
+        data = _backup_chunk(console, int(firmware_info['factory'], 0),
+                             ddr_base, 512)
+        if data is not None:
+            return hashlib.sha256(data).hexdigest()[:16]
+    return None
 
-    wait_for_realtek_cli(console)
 
-    with open("{}_padding".format(params['fwfile']), 'rb') as fw_flie:
-        raw = fw_flie.read()
-    j = 0
-    for i in range(0, len(raw), 16):
-        data = " ".join("{:02x}".format(c) for c in raw[i:i+16])
-        command = "eb {} {}\n".format(
-            hex(int(params['ddr_base'], 0) + j), data)
-        console.write(command.encode())
-        time.sleep(.1)
-        j = j + 16
-        if i % 8192 == 0 and int(i/8192) >= 1:
-            command = 'NANDW {} {} {}\n'.format(
-                hex(int(params['offset'], 0) + i),
-                params['ddr_base'], hex(8192))
-            console.write(command.encode())
-            console.write(b'y\n')
-            time.sleep(1)
-            console.write(b'\n')
-            params['ddr_base'] = '0xa1000000'
-            j = 0
-        data = (int(((i + 15) / len(raw)) * 100))
-        sys.stdout.write("Download progress: %d%%   \r" % (data))
-        sys.stdout.flush()
-#            print(command)
-#            if i > 1000:
-#                break
-    console.close()
-    os.remove("{}_padding".format(params['fwfile']))
-    print("Program flash Done!")
+def _nandw_ok(answer):
+    """ True if the answer of NANDW up to the prompt reports no error """
+    return answer is not None and \
+        not any(error in answer.lower() for error in NANDW_ERRORS)
 
 
-def burn_by_xmodem(params, in_flasher=False):
-    # pylint: disable=unused-argument
-    """ burn by xmodem """
+@telemetry.flow('xmodem')
+def burn_by_xmodem_blocks(params, in_flasher=False, retry=3):
+    """ burn by xmodem in erase blocks, resume from the journal,
+        only the blocks differing from the base are sent if it is set """
     console = None
 
-    remove_rawfile = False
-    with open(params['fwfile'], 'rb') as f_in:
-        data = f_in.read(16)
-        if data[:4] == b'cr6c' or data[:4] == b'r6cr':
-            with open("{}_raw".format(params['fwfile']), 'wb') as f_out:
-                f_out.write(f_in.read())
-            params['fwfile'] = "{}_raw".format(params['fwfile'])
-            remove_rawfile = True
-
-    if not _generate_padded_firmware(params['fwfile']):
+    raw = _read_firmware(params)
+    image = _padded_firmware(params, raw)
+    if image is None:
         print("Generate padded firmware Failed!")
         return False
+    fwsize = image.size
+    blocks = range(fwsize // ERASE_BLOCK_SIZE)
+    if params.get('base'):
+        base = _load_base(params)
+        if base is None:
+            return False
+        blocks = _delta_blocks(image, base)
+        print("Delta: {} of {} blocks changed.".format(
+            len(blocks), fwsize // ERASE_BLOCK_SIZE))
 
     console = _bootrom_download_flasher(params, console, in_flasher)
 
@@ -635,94 +2200,310 @@ def burn_by_xmodem(params, in_flasher=False):
 
     console.write(b'\n\n')
 
-    wait_for_realtek_cli(console)
-
-    command = "xmod {}\n".format(params['ddr_base'])
-    console.write(command.encode())
-    time.sleep(1)
-
-    clear_serial_buffer(console)
+    if not wait_for_realtek_cli(console):
+        console.close()
+        return False
 
-    print("Now transmitting {}".format(params['fwfile']))
-    fwsize = os.stat("{}_padding".format(params['fwfile'])).st_size
+    journal = BurnJournal(raw, params['offset'], params['comport'],
+                          _unit_id(console, params['ddr_base']))
+    blocks = [block for block in blocks if block not in journal.committed]
+    if journal.committed:
+        print("Resume {} of unit {} from {}: {} blocks committed, "
+              "{} left.".format(journal.path, journal.unit,
+                                time.ctime(journal.time),
+                                len(journal.committed), len(blocks)))
 
     def getc(size, timeout=1):
-        return console.read(size)
+        return console.read(size, timeout)
 
     def putc(data, timeout=1):
         return console.write(data)
 
-    if 'pyprind' in sys.modules:
-        def putc_user(data, timeout=1):
-            bar_user.update()
-            return console.write(data)
-
-        bar_user = pyprind.ProgBar(fwsize/1024 - 1, width=60)
-        modem = XMODEM1k(getc, putc_user)
-    else:
-        modem = XMODEM1k(getc, putc)
+    modem = XMODEM1k(getc, putc)
+    prompt = b'<RealTek>'
+    # the flasher runs one command at a time, so a block is sent and then
+    # programmed. It stays in DDR until the next xmod, a failed NANDW is
+    # retried without resending it
+    ddr_base = params['ddr_base']
+    for block in blocks:
+        start = block * ERASE_BLOCK_SIZE
+        image.seek(start)
+        block_data = image.read(ERASE_BLOCK_SIZE)
+        phase = telemetry.phase('xmod', ERASE_BLOCK_SIZE)
+        for _ in range(retry):
+            if run_serial_states(
+                    console, [_receive_state("xmod {}\n".format(ddr_base))],
+                    params['debug']) is None:
+                continue
+            modem.send(io.BytesIO(block_data))
+            answer = console.expect(prompt)
+            if answer is not None and b"Rx len=" in answer:
+                phase.done()
+                break
+        else:
+            print("Transmit block {} Error!".format(block))
+            console.close()
+            return False
 
-    with open("{}_padding".format(params['fwfile']), 'rb') as f_in:
-        modem.send(f_in)
+        phase = telemetry.phase('nandw', ERASE_BLOCK_SIZE)
+        for _ in range(retry):
+            command = 'NANDW {} {} {}\ny\n'.format(
+                hex(int(params['offset'], 0) + start), ddr_base,
+                hex(ERASE_BLOCK_SIZE))
+            console.write(command.encode())
+            if _nandw_ok(console.expect(prompt, timeout=60)):
+                journal.commit(block)
+                phase.done()
+                break
+        else:
+            print("Program block {} Error!".format(block))
+            console.close()
+            return False
+        sys.stdout.write("Programmed block %d of %d   \r" % (
+            block + 1, fwsize // ERASE_BLOCK_SIZE))
+        sys.stdout.flush()
 
-    data = str(console.read(console.in_waiting), encoding="utf-8")
-    if "Rx len=" not in data:
-        print("Transmit Error!")
+    sum_firmware = _firmware_sum(params, raw)
+    phase = telemetry.phase('boot_ctrl')
+    if not phase.done(_update_boot_info(console, params['fwtype'],
+                                        sum_firmware, fwsize)):
+        print("Update boot_info Error!")
         console.close()
-        os.remove("{}_padding".format(params['fwfile']))
         return False
-
-    print("Transmit Done! Please wait for programming to flash.")
-
-    command = 'NANDW {} {} {}\n'.format(
-        hex(int(params['offset'], 0)), params['ddr_base'], hex(fwsize))
-    console.write(command.encode())
-    console.write(b'y\n')
-    time.sleep(1)
-    wait_for_realtek_cli(console)
-
-    sum_firmware = calc_sum_of_firmware(params['fwfile'])
-    _update_boot_info(console, params['fwtype'], sum_firmware, fwsize)
+    journal.done()
 
     console.close()
-    if remove_rawfile and os.path.exists(params['fwfile']):
-        os.remove(params['fwfile'])
-    if os.path.exists("{}_padding".format(params['fwfile'])):
-        os.remove("{}_padding".format(params['fwfile']))
     print("Programming {} Done!".format(params['fwfile']))
     return True
 
 
-def _tftp_server():
-    thread = threading.currentThread()
-    while getattr(thread, "running", True):
+TFTP_RRQ = 1
+TFTP_DATA = 3
+TFTP_ACK = 4
+TFTP_ERROR = 5
+TFTP_OACK = 6
+
+
+class TftpServer:
+    """ read-only tftp server of registered images (RFC 1350), it
+        negotiates blksize (RFC 2348), tsize (RFC 2349) and windowsize
+        (RFC 7440) when the client asks for them """
+
+    def __init__(self, host='0.0.0.0', port=69, timeout=1.0, retries=5,
+                 max_blksize=1468, max_windowsize=32):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.host = host
+        self.timeout = timeout
+        self.retries = retries
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.images = {}
+        self.transfers = []
+        self._stop = threading.Event()
+        # the serve thread adds the transfer threads while stop() joins
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def register(self, name, image):
+        """ serve image, a PaddedImage or a bytes-like object, as name """
+        if not isinstance(image, PaddedImage):
+            image = PaddedImage(image, align=1)
+        self.images[name] = image
+
+    def start(self):
+        """ start serving in a thread """
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        with self._lock:
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """ stop serving, wait for running transfers to end """
+        self._stop.set()
+        while True:
+            with self._lock:
+                threads, self._threads = self._threads, []
+            if not threads:
+                break
+            for thread in threads:
+                thread.join()
+        self.sock.close()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            if not select.select([self.sock], [], [], .2)[0]:
+                continue
+            try:
+                packet, address = self.sock.recvfrom(65536)
+            except OSError:
+                if self._stop.is_set():
+                    break
+                continue
+            # an ERROR is never answered (RFC 1350)
+            if len(packet) < 2 or \
+                    struct.unpack('!H', packet[:2])[0] == TFTP_ERROR:
+                continue
+            request = None
+            if struct.unpack('!H', packet[:2])[0] == TFTP_RRQ:
+                request = _parse_rrq(packet)
+            if request is None:
+                _send_tftp_error(self.sock, address, 4,
+                                 'Illegal TFTP operation')
+                continue
+            thread = threading.Thread(
+                target=self._transfer, args=(address,) + request)
+            thread.daemon = True
+            thread.start()
+            with self._lock:
+                self._threads.append(thread)
+
+    def _send_and_wait(self, sock, address, packets, expect):
+        """ send packets until an ACK in expect comes,
+            return (acked block, retransmits) or (None, retransmits) """
+        for retry in range(self.retries):
+            try:
+                for packet in packets:
+                    sock.sendto(packet, address)
+            except OSError:
+                return None, retry
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline and not self._stop.is_set():
+                if not select.select([sock], [], [],
+                                     deadline - time.monotonic())[0]:
+                    break
+                try:
+                    packet, peer = sock.recvfrom(65536)
+                except OSError:
+                    # e.g. ICMP port unreachable, retransmit
+                    break
+                if peer != address or len(packet) < 4:
+                    continue
+                opcode, block = struct.unpack('!HH', packet[:4])
+                if opcode == TFTP_ERROR:
+                    return None, retry
+                if opcode == TFTP_ACK and block in expect:
+                    return block, retry
+            if self._stop.is_set():
+                break
+        return None, self.retries
+
+    def _transfer(self, address, filename, options):
+        # pylint: disable=too-many-locals
+        image = self.images.get(os.path.basename(filename))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, 0))
         try:
-            server = tftpy.TftpServer(getattr(thread, "path", '.'))
-            server.listen('0.0.0.0', 69)
-        except KeyboardInterrupt:
-            break
+            if image is None:
+                _send_tftp_error(sock, address, 1, 'File not found')
+                return
+            image = image.reopen()
+            blksize = 512
+            windowsize = 1
+            oack = {}
+            if 'blksize' in options:
+                blksize = max(8, min(int(options['blksize']),
+                                     self.max_blksize))
+                oack['blksize'] = blksize
+            if 'windowsize' in options:
+                windowsize = max(1, min(int(options['windowsize']),
+                                        self.max_windowsize))
+                oack['windowsize'] = windowsize
+            if 'tsize' in options:
+                oack['tsize'] = image.size
+            start = time.monotonic()
+            retransmits = 0
+            if oack:
+                packet = struct.pack('!H', TFTP_OACK) + b''.join(
+                    '{}\0{}\0'.format(key, val).encode()
+                    for key, val in oack.items())
+                acked, retry = self._send_and_wait(sock, address, [packet],
+                                                   (0,))
+                retransmits = retransmits + retry
+                if acked is None:
+                    return
+            # the last block is shorter than blksize, maybe empty
+            blocks = image.size // blksize + 1
+            block = 1
+            while block <= blocks:
+                window = range(block, min(block + windowsize, blocks + 1))
+                packets = []
+                for index in window:
+                    image.seek((index - 1) * blksize)
+                    packets.append(struct.pack(
+                        '!HH', TFTP_DATA, index & 0xffff) +
+                        image.read(blksize))
+                acked, retry = self._send_and_wait(
+                    sock, address, packets,
+                    {index & 0xffff: index for index in window})
+                if acked is None:
+                    print("TFTP transfer of {} timeout!".format(filename))
+                    return
+                # resume after the last block the client has
+                block = [index for index in window
+                         if index & 0xffff == acked][0] + 1
+                retransmits = (retransmits + retry * len(packets) +
+                               window[-1] + 1 - block)
+            elapsed = time.monotonic() - start
+            self.transfers.append({
+                'name': filename, 'size': image.size,
+                'seconds': elapsed, 'retransmits': retransmits,
+                'blksize': blksize, 'windowsize': windowsize})
+            print("TFTP sent {} ({} bytes) in {:.1f}s, {:.0f} KB/s, "
+                  "blksize {}, windowsize {}, {} retransmits".format(
+                      filename, image.size, elapsed,
+                      image.size / max(elapsed, 1e-6) / 1024, blksize,
+                      windowsize, retransmits))
+        finally:
+            sock.close()
+
+
+def _parse_rrq(packet):
+    """ (filename, options) of a RRQ packet, None if it is malformed """
+    if len(packet) < 4 or packet[-1:] != b'\0':
+        return None
+    try:
+        fields = packet[2:-1].decode('ascii').split('\0')
+    except UnicodeDecodeError:
+        return None
+    # filename, mode and pairs of option and value
+    if len(fields) % 2 or not fields[0]:
+        return None
+    options = {fields[i].lower(): fields[i + 1]
+               for i in range(2, len(fields), 2)}
+    for key in ('blksize', 'windowsize'):
+        if key in options and not options[key].isdigit():
+            return None
+    return fields[0], options
+
+
+def _send_tftp_error(sock, address, code, message):
+    """ send an ERROR packet, a failure is ignored """
+    try:
+        sock.sendto(struct.pack('!HH', TFTP_ERROR, code) +
+                    message.encode() + b'\0', address)
+    except OSError:
+        pass
 
 
+@telemetry.flow('tftp')
 def burn_by_tftp(params, in_flasher=False):
-    """ burn by tftp """
+    """ burn by tftp, only the blocks differing from the base are sent
+        if it is set """
     console = None
 
-    remove_rawfile = False
-    with open(params['fwfile'], 'rb') as f_in:
-        raw = f_in.read(16)
-        if raw[:4] == b'cr6c' or raw[:4] == b'r6cr':
-            with open("{}_raw".format(params['fwfile']), 'wb') as f_out:
-                f_out.write(f_in.read())
-            params['fwfile'] = "{}_raw".format(params['fwfile'])
-            remove_rawfile = True
-
-    if not _generate_padded_firmware(params['fwfile']):
+    raw = _read_firmware(params)
+    image = _padded_firmware(params, raw)
+    if image is None:
         print("Generate padded firmware Failed!")
         return False
-
-    if "tftpy" not in sys.modules:
-        print("Please install tftpy!")
-        return False
+    base = None
+    if params.get('base'):
+        base = _load_base(params)
+        if base is None:
+            return False
 
     console = _bootrom_download_flasher(params, console, in_flasher)
 
@@ -730,215 +2511,830 @@ def burn_by_tftp(params, in_flasher=False):
         print("Goto flasher failed, try again.")
         return False
 
-    thread = threading.Thread(target=_tftp_server)
-    thread.running = True
-    thread.path = os.path.dirname(os.path.abspath(params['fwfile']))
-    thread.start()
+    image_name = "{}_padding".format(os.path.basename(params['fwfile']))
+    # (offset in image, length) of each transfer
+    runs = [(0, len(raw))]
+    if base is not None:
+        blocks = _delta_blocks(image, base)
+        print("Delta: {} of {} blocks changed.".format(
+            len(blocks), image.size // ERASE_BLOCK_SIZE))
+        runs = []
+        for block in blocks:
+            if runs and runs[-1][0] + runs[-1][1] == \
+                    block * ERASE_BLOCK_SIZE:
+                runs[-1] = (runs[-1][0], runs[-1][1] + ERASE_BLOCK_SIZE)
+            else:
+                runs.append((block * ERASE_BLOCK_SIZE, ERASE_BLOCK_SIZE))
+    try:
+        server = TftpServer()
+    except OSError:
+        print("Create tftp server error")
+        console.close()
+        return False
+    server.start()
 
-    command = "tftp {} {}_padding\n".format(
-        params['ddr_base'], os.path.basename(params['fwfile']))
-    console.write(command.encode())
+    for start, length in runs:
+        name = image_name
+        if base is None:
+            server.register(name, image)
+        else:
+            name = "{}_{}".format(image_name, hex(start))
+            image.seek(start)
+            server.register(name, image.read(length))
+        command = "tftp {} {}\n".format(params['ddr_base'], name)
+        phase = telemetry.phase('tftp', length)
+        console.write(command.encode())
 
-    wait_for_realtek_cli(console)
-    thread.running = False
-    time.sleep(1)
+        if not phase.done(wait_for_realtek_cli(console, timeout=300)):
+            server.stop()
+            console.close()
+            return False
 
-    command = 'NANDW {} {} {}\n'.format(
-        hex(int(params['offset'], 0)),
-        params['ddr_base'],
-        hex(os.stat(params['fwfile']).st_size))
-    console.write(command.encode())
-    console.write(b'y\n')
-    thread.join()
+        command = 'NANDW {} {} {}\n'.format(
+            hex(int(params['offset'], 0) + start),
+            params['ddr_base'],
+            hex(length))
+        phase = telemetry.phase('nandw', length)
+        console.write(command.encode())
+        console.write(b'y\n')
 
-    wait_for_realtek_cli(console)
-    sum_firmware = calc_sum_of_firmware(params['fwfile'])
-    _update_boot_info(console, params['fwtype'],
-                     sum_firmware, os.stat(params['fwfile']).st_size)
+        if not phase.done(wait_for_realtek_cli(console, timeout=120)):
+            server.stop()
+            console.close()
+            return False
+    server.stop()
+    sum_firmware = _firmware_sum(params, raw)
+    phase = telemetry.phase('boot_ctrl')
+    if not phase.done(_update_boot_info(console, params['fwtype'],
+                                        sum_firmware, len(raw))):
+        print("Update boot_info Error!")
+        console.close()
+        return False
 
-    if os.path.exists("{}_padding".format(params['fwfile'])):
-        os.remove("{}_padding".format(params['fwfile']))
-    if remove_rawfile and os.path.exists(params['fwfile']):
-        os.remove(params['fwfile'])
+    console.close()
     print("Program {} Done!".format(params['fwfile']))
     return True
 
 
 def _prepare_firmware(fwfile, fwtype):
-    with open(fwfile, 'rb') as f_in:
-        raw = f_in.read(16)
-        if raw[:4] != b'cr6c' and raw[:4] != b'r6cr':
-            if raw[:4] == b'hsqs':
-                pass
-            elif raw[:8] == b'\x00\x00\x00\x00\x00\x00\x00\x00':
-                raw = f_in.read(48)
-                if raw[28:36] == b'\x21\x80\x00\x00\x00\x60\x90\x40':
-                    pass
-                else:
-                    print("The {} is invaild firmware for fw_update.".format(
-                        fwfile))
-                    return None
-            else:
-                print("The {} is invaild firmware for fw_update.".format(
-                      fwfile))
-                return None
-            return generate_firmware_for_fw_update(fwfile, fwtype)
+    """ path of the fw_update image of fwfile, generated once per content
+        and fw type into the artifact cache """
+    entry = get_catalog().lookup(fwfile)
+    kind = 'unknown' if entry is None else entry['kind']
+    if kind in ('cr6c', 'r6cr'):
         return fwfile
+    if kind not in ('hsqs', 'linux_raw'):
+        print("The {} is invaild firmware for fw_update.".format(fwfile))
+        return None
+    cache = get_artifact_cache()
+    key = '{}_{}'.format(get_sum_cache().digest(fwfile)[:32], fwtype)
+    cached = cache.get(key)
+    if cached is not None:
+        return cache.file(cached)
+    tmpfile = cache.new_file('.bin')
+    filename = generate_firmware_for_fw_update(fwfile, fwtype, tmpfile)
+    if filename is None:
+        cache.discard(tmpfile)
+        return None
+    return cache.file(cache.put(key, {'fwtype': fwtype,
+                                      'source': os.path.basename(fwfile)},
+                                filename))
 
 
-def _http_server():
-    thrd = threading.currentThread()
-    base_path = getattr(thrd, "base_path", "./")
-    port = getattr(thrd, "port", 8000)
+def _fw_update_name(fwfile, prepared):
+    """ name of the prepared fw_update image of fwfile on the gateway """
+    if prepared == fwfile:
+        return os.path.basename(fwfile)
+    return "{}_fw_update.bin".format(
+        os.path.splitext(os.path.basename(fwfile))[0])
 
-    try:
-        if os.path.isdir(base_path):
-            os.chdir(base_path)
-            open("{}/favicon.ico".format(base_path), 'a').close()
-        handler = http.server.SimpleHTTPRequestHandler
-        handler.log_message = lambda a, b, c, d, f: None
-        with socketserver.TCPServer(("", port), handler) as httpd:
-            while getattr(thrd, "running", True):
-                httpd.handle_request()
-    except KeyboardInterrupt:
-        # print('Keyboard interrupt received: EXITING')
-        return
-    except (ConnectionResetError, FileNotFoundError):
+
+class _ImageRequestHandler:
+    """ GET/HEAD with Range of the images registered to the server,
+        mixed into http.server.BaseHTTPRequestHandler by ImageServer """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
         pass
-    except OSError:
-        print("Create http server error")
-        return
-#    except Exception:
-#        pass
-    finally:
-        if os.path.exists("{}/favicon.ico".format(base_path)):
-            os.remove("{}/favicon.ico".format(base_path))
 
+    def _send_head(self):
+        """ send headers, return (source, start, length) or None """
+        source = self.server.images.get(self.path.lstrip('/'))
+        if source is None:
+            self.send_error(404)
+            return None
+        size = os.stat(source).st_size if isinstance(source, str) \
+            else len(source)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$',
+                         self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if not match.group(1):
+                start = max(0, size - int(match.group(2)))
+            else:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return source, start, end - start + 1
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """ HEAD """
+        self._send_head()
+
+    def _send_digested(self, source, length, digest):
+        """ send the whole source, hashing it from digest.offset on """
+        f_in = open(source, 'rb') if isinstance(source, str) else None
+        sent = 0
+        while sent < length:
+            size = min(SUM_BLOCK_SIZE, length - sent)
+            data = f_in.read(size) if f_in else source[sent:sent + size]
+            self.wfile.write(data)
+            if sent + size > digest.offset:
+                digest.hasher.update(data[max(0, digest.offset - sent):])
+            sent = sent + size
+        if f_in:
+            f_in.close()
+        if not digest.future.done():
+            digest.future.set_result(digest.hasher.hexdigest())
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ GET, files are sent by sendfile unless they are digested """
+        head = self._send_head()
+        if head is None:
+            return
+        source, start, length = head
+        self.wfile.flush()
+        digest = self.server.digests.get(self.path.lstrip('/'))
+        if digest is not None and start == 0 and \
+                not digest.future.done() and \
+                self.headers.get('Range') is None:
+            self._send_digested(source, length, digest)
+        elif isinstance(source, str):
+            with open(source, 'rb') as f_in:
+                self.connection.sendfile(f_in, start, length)
+        else:
+            self.wfile.write(source[start:start + length])
+
+
+ServedDigest = collections.namedtuple('ServedDigest',
+                                      ['offset', 'hasher', 'future'])
+
+
+class ImageServer:
+    """ threaded http server of registered files or in-memory images,
+        listening on an ephemeral port """
+
+    def __init__(self, port=0):
+        _import_telnet_modules()
+        handler = type('ImageRequestHandler', (
+            _ImageRequestHandler, http.server.BaseHTTPRequestHandler), {})
+        self.httpd = http.server.ThreadingHTTPServer(('', port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.images = {}
+        self.httpd.digests = {}
+        self.thread = None
+
+    @property
+    def port(self):
+        """ listening port """
+        return self.httpd.server_address[1]
+
+    def register(self, name, source, digest_offset=None):
+        """ serve source, a file path or a bytes-like object, as /name.
+            with digest_offset, the md5 of source[digest_offset:] is
+            computed while it is first sent, see digest() """
+        if not isinstance(source, str):
+            source = memoryview(source).cast('B')
+        self.httpd.images[name] = source
+        if digest_offset is not None:
+            self.httpd.digests[name] = ServedDigest(
+                digest_offset, hashlib.md5(),
+                concurrent.futures.Future())
+        return name
+
+    def digest(self, name, timeout=None):
+        """ md5 hexdigest of the image sent as name, None if it was not
+            sent in full within timeout """
+        try:
+            return self.httpd.digests[name].future.result(timeout)
+        except (KeyError, concurrent.futures.TimeoutError):
+            return None
+
+    def url(self, name, host):
+        """ url of name for the client which reaches this host as host """
+        return "http://{}:{}/{}".format(host, self.port, name)
+
+    def start(self):
+        """ start serving in a thread """
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ stop serving and close the socket """
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.httpd.server_close()
+
+
+MTD_PARTITIONS = [name for name in firmware_info if name != 'silabs_ncp_bt']
+
+
+def _mtd_device(fwtype, slot):
+    """ /dev/mtdN of the kernel/linux or rootfs partition of slot """
+    name = '{}_{}'.format('rootfs' if 'rootfs' in fwtype else 'linux', slot)
+    return '/dev/mtd{}'.format(MTD_PARTITIONS.index(name))
+
+
+def _gzip_firmware(source):
+    """ (path, meta) of the gzip of source, a file or a bytes-like object,
+        cached by its sha256. meta has the size and md5 of source and the
+        md5 of its payload after the 16-byte cr6c/r6cr header """
+    data = _map_file(source) if isinstance(source, str) \
+        else memoryview(source).cast('B')
+    cache = get_artifact_cache()
+    # the files of the artifact cache are not kept in the sum cache
+    if isinstance(source, str) and os.path.dirname(
+            os.path.abspath(source)) != os.path.abspath(cache.path):
+        digest = get_sum_cache().digest(source)
+    else:
+        digest = hashlib.sha256(data).hexdigest()
+    key = '{}_gzip'.format(digest[:32])
+    cached = cache.get(key)
+    if cached is not None:
+        return cache.file(cached), cached['meta']
+
+    md5 = hashlib.md5(data[:16])
+    payload_md5 = hashlib.md5()
+    with open(cache.new_file('.gz'), 'wb') as f_tmp:
+        with gzip.GzipFile(fileobj=f_tmp, mode='wb', mtime=0) as f_out:
+            f_out.write(data[:16])
+            for i in range(16, len(data), SUM_BLOCK_SIZE):
+                block = data[i:i + SUM_BLOCK_SIZE]
+                f_out.write(block)
+                md5.update(block)
+                payload_md5.update(block)
+    meta = {'size': len(data), 'gzip_size': os.stat(f_tmp.name).st_size,
+            'md5': md5.hexdigest(), 'payload_md5': payload_md5.hexdigest()}
+    cached = cache.put(key, meta, f_tmp.name)
+    return cache.file(cached), meta
+
+
+def _check_file_via_telnet(console, path, meta, timeout=120):
+    """ compare size and md5 of path on the gateway with meta """
+    command = "wc -c {0}; md5sum {0}\n".format(path)
+    console.write(command.encode())
+    raw = console.read_until(b"\n# ", timeout)
+    size = re.search(rb'\b(\d+)\s+' + re.escape(path.encode()), raw)
+    md5 = re.search(rb'\b([0-9a-f]{32})\b', raw)
+    if size is None or md5 is None or int(size.group(1)) != meta['size'] \
+            or md5.group(1).decode() != meta['md5']:
+        print("The downloaded {} is broken!".format(path))
+        return False
+    return True
 
-def burn_via_telnet(params, http_server=False, close_http_server=False):
-    # pylint: disable=too-many-statements
-    """ burn_firmware by telnet """
-    http_server_port = 8000
 
-    if ("telnetlib" not in sys.modules or "http.server" not in sys.modules
-            or "socketserver" not in sys.modules):
-        print("Please install telnetlib, http.server and socketserver!")
+def _verify_via_telnet(console, digest, device, size, timeout=600):
+    """ compare the md5 of the first size bytes of device with digest """
+    command = "head -c {} {} | md5sum\n".format(size, device)
+    console.write(command.encode())
+    raw = console.read_until(b"\n# ", timeout)
+    match = re.search(rb'\b([0-9a-f]{32})\b', raw)
+    if digest is None or match is None:
+        print("Cannot read the md5 of {}!".format(device))
+        return False
+    if match.group(1).decode() != digest:
+        print("Verify {} failed: {} on gateway, {} expected!".format(
+            device, match.group(1).decode(), digest))
         return False
+    print("Verify {} OK ({}).".format(device, digest))
+    return True
 
-    fwfile = _prepare_firmware(params['fwfile'], params['fwtype'])
-    if fwfile is None:
-        print("Prepare firmware Failed!")
+
+@telemetry.flow('telnet')
+def burn_via_telnet(params, http_server=None):
+    # pylint: disable=too-many-statements
+    """ burn_firmware by telnet, http_server is a running ImageServer
+        to share, otherwise one is started for this burn """
+    _import_telnet_modules()
+    if "telnetlib" not in sys.modules or "http.server" not in sys.modules:
+        print("Please install telnetlib and http.server!")
         return False
 
+    fwname = os.path.basename(params['fwfile'])
+    if params.get('fwdata') is not None:
+        # sections of MIOT firmware are served as they are
+        source = params['fwdata']
+    else:
+        source = _prepare_firmware(params['fwfile'], params['fwtype'])
+        if source is None:
+            print("Prepare firmware Failed!")
+            return False
+        fwname = _fw_update_name(params['fwfile'], source)
+
+    phase = telemetry.phase('login')
     try:
-        console = Telnet(params['ipaddr'], 23)
-    except TimeoutError:
+        console = Telnet(*_split_address(params['ipaddr']))
+    except (TimeoutError, OSError):
         print("Cannot connect to gateway 3!")
         return False
     console.write(b"\n")
     console.read_until(b"login: ")
     console.write(b"admin\n")
     console.read_until(b"\n# ")
+    phase.done()
 
     console.write(b"boot_ctrl show\n")
     raw = console.read_until(b"\n# ")
 
-    if "linux" in params['fwtype']:
-        data = str(raw)[str(raw).find("kernel:") + 10]
+    slot = None
+    if "linux" in params['fwtype'] or "kernel" in params['fwtype']:
+        slot = str(raw)[str(raw).find("kernel:") + 10]
         print("Gateway currently booted kernel slot is {} "
-              "and will flash another slot.".format(data))
+              "and will flash another slot.".format(slot))
     if "rootfs" in params['fwtype']:
-        data = str(raw)[str(raw).find("rootfs:") + 10]
+        slot = str(raw)[str(raw).find("rootfs:") + 10]
         print("Gateway currently booted rootfs slot is {} "
-              "and will flash another slot.".format(data))
-
-    if not http_server:
-        httpserver_thread = threading.Thread(target=_http_server)
-        httpserver_thread.base_path = os.path.dirname(
-            os.path.abspath(fwfile))
-        httpserver_thread.port = http_server_port
-        httpserver_thread.start()
-
-    host_ip = socket.gethostbyname(socket.gethostname())
-
-    command = "wget http://{0}:{1}/{2} -O /tmp/{2}\n".format(
-        host_ip, http_server_port,
-        os.path.basename(fwfile))
+              "and will flash another slot.".format(slot))
+
+    own_server = http_server is None
+    if own_server:
+        http_server = ImageServer().start()
+    verify = params.get('verify') and slot in ('0', '1')
+    verified = False
+    host = _local_ip_for(_split_address(params['ipaddr'])[0])
+    if params.get('gzip'):
+        gzfile, meta = _gzip_firmware(source)
+        print("Serve {} bytes gzip of {} bytes.".format(
+            meta['gzip_size'], meta['size']))
+        http_server.register('{}.gz'.format(fwname), gzfile)
+        command = "wget {} -O - | gunzip > /tmp/{}\n".format(
+            http_server.url('{}.gz'.format(fwname), host), fwname)
+        phase = telemetry.phase('wget', meta['gzip_size'])
+    else:
+        # fw_update writes the image without its cr6c/r6cr header
+        http_server.register(fwname, source, 16 if verify else None)
+        command = "wget {} -O /tmp/{}\n".format(
+            http_server.url(fwname, host), fwname)
+        phase = telemetry.phase('wget', os.stat(source).st_size
+                                if isinstance(source, str) else len(source))
 
     console.write(command.encode())
     console.read_until(b"\n# ")
-
-    if params['fwtype'] == 'silabs_ncp_bt':
-        fwversion = '125' if re.search(
-            r'_([0-9])+.gbl', fwfile) is None else fwversion.group(1)
-
-        command = "run_ble_dfu.sh /dev/ttyS1 {} {} 1\n".format(
-            os.path.basename(fwfile), fwversion)
+    phase.done()
+    if params.get('gzip') and not telemetry.phase('check').done(
+            _check_file_via_telnet(console, '/tmp/{}'.format(fwname),
+                                   meta)):
+        console.write("rm /tmp/{}\n".format(fwname).encode())
+        console.read_until(b"\n# ")
+    elif params['fwtype'] == 'silabs_ncp_bt':
+        fwversion = re.search(r'_([0-9]+).gbl', fwname)
+        fwversion = '125' if fwversion is None else fwversion.group(1)
+
+        # the script prints no result, its exit status is echoed
+        command = "run_ble_dfu.sh /dev/ttyS1 {} {} 1; echo ble_dfu=$?\n" \
+            .format(fwname, fwversion)
+        phase = telemetry.phase('fw_update')
         console.write(command.encode())
+        raw = console.read_until(b"\n# ")
+        verified = phase.done(b'ble_dfu=0' in raw)
+        print("run_ble_dfu.sh {}!".format(
+            'successfully' if verified else 'failed'))
     else:
-        command = "fw_update /tmp/{}\n".format(os.path.basename(fwfile))
+        command = "fw_update /tmp/{}\n".format(fwname)
+        phase = telemetry.phase('fw_update')
         console.write(command.encode())
         raw = console.read_until(b"\n# ")
-        if 'Success' in str(raw):
+        if phase.done('Success' in str(raw)):
             print("fw_update successfully!")
+            verified = True
+            if verify:
+                size = (os.stat(source).st_size if isinstance(source, str)
+                        else len(source)) - 16
+                # the host digest is already done as wget has finished
+                digest = meta['payload_md5'] if params.get('gzip') \
+                    else http_server.digest(fwname, timeout=10)
+                phase = telemetry.phase('verify', size)
+                verified = phase.done(_verify_via_telnet(
+                    console, digest,
+                    _mtd_device(params['fwtype'], 1 - int(slot)), size))
         else:
             print("fw_update failed!")
 
-    if close_http_server:
-        httpserver_thread.running = False
-        # hotfix_http_thread
-        data = 'favicon.ico'
-        command = "wget http://{0}:{1}/{2} -O /tmp/{2}\n".format(
-                host_ip, http_server_port, data)
-        console.write(command.encode())
-        httpserver_thread.join()
-    if os.path.basename(fwfile) != os.path.basename(params['fwfile']):
-        os.remove(fwfile)
+    if own_server:
+        http_server.stop()
     console.close()
 
-    return True
+    return verified
+
+
+TELNET_IAC = 255
+TELNET_SB = 250
+TELNET_SE = 240
+TELNET_WILL = 251
+TELNET_WONT = 252
+TELNET_DO = 253
+TELNET_DONT = 254
+
+
+class AsyncTelnet:
+    """ minimal telnet client on asyncio, refuses all options like
+        telnetlib does """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buf = b''
+        self._cmd = b''
+
+    @classmethod
+    async def open(cls, host, port=23, timeout=10):
+        """ connect to host """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+        return cls(reader, writer)
+
+    def _filter(self, data):
+        """ strip and answer telnet commands """
+        out = bytearray()
+        for byte in data:
+            if not self._cmd:
+                if byte == TELNET_IAC:
+                    self._cmd = bytes([byte])
+                else:
+                    out.append(byte)
+                continue
+            self._cmd = self._cmd + bytes([byte])
+            if self._cmd == bytes([TELNET_IAC, TELNET_IAC]):
+                out.append(TELNET_IAC)
+                self._cmd = b''
+            elif self._cmd[1] == TELNET_SB:
+                if self._cmd[-2:] == bytes([TELNET_IAC, TELNET_SE]):
+                    self._cmd = b''
+            elif self._cmd[1] in (TELNET_WILL, TELNET_WONT):
+                if len(self._cmd) == 3:
+                    self.writer.write(bytes([TELNET_IAC, TELNET_DONT,
+                                             self._cmd[2]]))
+                    self._cmd = b''
+            elif self._cmd[1] in (TELNET_DO, TELNET_DONT):
+                if len(self._cmd) == 3:
+                    self.writer.write(bytes([TELNET_IAC, TELNET_WONT,
+                                             self._cmd[2]]))
+                    self._cmd = b''
+            else:
+                self._cmd = b''
+        return bytes(out)
+
+    async def read_until(self, match, timeout=60):
+        """ read until match, raise asyncio.TimeoutError or EOFError """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        deadline = time.monotonic() + timeout
+        while match not in self.buf:
+            data = await asyncio.wait_for(
+                self.reader.read(4096),
+                max(0.0, deadline - time.monotonic()))
+            if not data:
+                raise EOFError("connection closed")
+            self.buf = self.buf + self._filter(data)
+        end = self.buf.index(match) + len(match)
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return data
+
+    def write(self, data):
+        """ write data """
+        self.writer.write(data.replace(b'\xff', b'\xff\xff'))
+
+    def close(self):
+        """ close the connection """
+        self.writer.close()
+
+
+def _split_address(address, port=23):
+    """ split ip[:port] """
+    if ':' in address:
+        address, port = address.rsplit(':', 1)
+    return address, int(port)
+
+
+def _local_ip_for(address):
+    """ ip of this host as seen by address """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect((address, 9))
+            return sock.getsockname()[0]
+        except OSError:
+            return socket.gethostbyname(socket.gethostname())
+
+
+async def _fleet_update_gateway(address, fwtype, fwname, http_port,
+                                semaphore):
+    """ update one gateway of the fleet, return (ok, message) """
+    async with semaphore:
+        host, port = _split_address(address)
+        console = await AsyncTelnet.open(host, port)
+        try:
+            console.write(b"\n")
+            await console.read_until(b"login: ")
+            console.write(b"admin\n")
+            await console.read_until(b"\n# ")
+
+            console.write(b"boot_ctrl show\n")
+            raw = str(await console.read_until(b"\n# "))
+            slot = raw[raw.find("kernel:" if "linux" in fwtype
+                                else "rootfs:") + 10]
+
+            console.write("wget http://{0}:{1}/{2} -O /tmp/{2}\n".format(
+                _local_ip_for(host), http_port, fwname).encode())
+            await console.read_until(b"\n# ", timeout=600)
+
+            console.write("fw_update /tmp/{}\n".format(fwname).encode())
+            raw = await console.read_until(b"\n# ", timeout=600)
+            if b'Success' not in raw:
+                return False, "fw_update failed, booted slot {}".format(slot)
+            return True, "fw_update successfully, booted slot {}".format(
+                slot)
+        finally:
+            console.close()
+
+
+async def _fleet_update(addresses, fwtype, fwname, http_port, concurrency):
+    """ update all gateways, return {address: (ok, message, seconds)} """
+    import asyncio  # pylint: disable=import-outside-toplevel
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def update(address):
+        start = time.monotonic()
+        try:
+            result = await _fleet_update_gateway(
+                address, fwtype, fwname, http_port, semaphore)
+        except (OSError, EOFError, asyncio.TimeoutError) as err:
+            result = (False, "{}: {}".format(type(err).__name__, err))
+        return address, result + (time.monotonic() - start,)
+
+    return dict(await asyncio.gather(*[update(address)
+                                       for address in addresses]))
+
+
+def burn_fleet(params, addresses, concurrency=8):
+    """ burn firmware to many gateways by telnet concurrently """
+
+    if params['fwtype'] not in ('linux_0', 'linux_1', 'rootfs_0',
+                                'rootfs_1'):
+        print("Fleet mode only support linux and rootfs!")
+        return False
+    fwfile = _prepare_firmware(params['fwfile'], params['fwtype'])
+    if fwfile is None:
+        print("Prepare firmware Failed!")
+        return False
+    fwname = _fw_update_name(params['fwfile'], fwfile)
+
+    import asyncio  # pylint: disable=import-outside-toplevel
+    http_server = ImageServer().start()
+    http_server.register(fwname, fwfile)
+
+    start = time.monotonic()
+    try:
+        results = asyncio.run(_fleet_update(
+            addresses, params['fwtype'], fwname, http_server.port,
+            concurrency))
+    finally:
+        http_server.stop()
+
+    for address in addresses:
+        ok, message, elapsed = results[address]
+        print("{:<21} {:<4} {:>6.1f}s {}".format(
+            address, 'OK' if ok else 'FAIL', elapsed, message))
+    print("Updated {} of {} gateways in {:.1f}s.".format(
+        sum(1 for result in results.values() if result[0]),
+        len(addresses), time.monotonic() - start))
+    return all(result[0] for result in results.values())
+
+
+class _StationOutput:
+    """ sys.stdout and sys.stderr of a station run, the last line written
+        by the thread of a port, named as the port, is kept as the status
+        of the port """
+
+    def __init__(self, stream, ports):
+        self.stream = stream
+        self.ports = set(ports)
+        self.status = {}
+
+    def write(self, text):
+        """ write text of the main thread, keep the last line of a port """
+        port = threading.current_thread().name
+        if port not in self.ports:
+            return self.stream.write(text)
+        lines = [line.strip() for line in re.split(r'[\r\n]', text)
+                 if line.strip()]
+        if lines:
+            self.status[port] = lines[-1]
+        return len(text)
+
+    def flush(self):
+        """ flush the stream """
+        self.stream.flush()
+
+
+def _prepare_station_job(job):
+    """ params of a station job, a dict of fwtype and fwfile or
+        fwversion, with the image read and padded once for all ports,
+        None if it is invalid """
+    fwtype, fwfile = job.get('fwtype'), job.get('fwfile')
+    fwdata = None
+    if firmware_info.get(fwtype, '0') == '0' or fwtype == 'silabs_ncp_bt':
+        print("Station mode cannot burn {}!".format(fwtype))
+        return None
+    if fwfile is None and job.get('fwversion'):
+        fwfile, section = get_catalog().find(str(job['fwversion']), fwtype)
+        if fwfile is None:
+            print("The {} of {} is not in the catalog!".format(
+                fwtype, job['fwversion']))
+            return None
+        if section is not None:
+            fwdata = _extract_firmwares(fwfile).section_data(section)
+            fwfile = '{}_{}.bin'.format(section, job['fwversion'])
+    if fwdata is None and (fwfile is None or not os.path.isfile(fwfile)):
+        print("The {} is not exist!".format(fwfile))
+        return None
+    params = {'fwfile': fwfile, 'fwdata': fwdata}
+    raw = _read_firmware(params)
+    image = _padded_firmware(params, raw)
+    if image is None:
+        print("Generate padded firmware of {} Failed!".format(fwfile))
+        return None
+    return {'fwtype': fwtype, 'fwfile': fwfile, 'fwdata': raw,
+            'image': image, 'offset': firmware_info[fwtype],
+            'fwsum': _firmware_sum(params, raw)}
+
+
+def load_station_jobs(job_file):
+    """ jobs of a yaml file, a list of dicts of fwtype and fwfile or
+        fwversion, None if it is invalid """
+    try:
+        import yaml  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        yaml = None
+    if yaml is None or not os.path.isfile(job_file):
+        print("Yaml file Error!")
+        return None
+    with open(job_file, 'r') as f_in:
+        jobs = yaml.safe_load(f_in)
+    if not isinstance(jobs, list) or not all(
+            isinstance(job, dict) and 'fwtype' in job for job in jobs):
+        print("{} is not a list of jobs with fwtype!".format(job_file))
+        return None
+    return jobs
+
+
+def _station_port(params, jobs, results):
+    """ burn jobs in order through params['comport'], the flasher is
+        downloaded for the first one only """
+    burn = burn_by_xmodem_blocks if params.get('blocks') or \
+        params.get('base') else burn_by_xmodem
+    port = params['comport']
+    telemetry.local.port = port
+    start = time.monotonic()
+    done = 0
+    try:
+        for index, job in enumerate(jobs):
+            if not burn(dict(params, **job), in_flasher=index > 0):
+                break
+            done = done + 1
+    except Exception as err:  # pylint: disable=broad-except
+        print("{}: {}".format(type(err).__name__, err))
+    results[port] = (done == len(jobs), done, time.monotonic() - start)
+
+
+def burn_station(params, comports, jobs, interval=1.0):
+    """ burn the jobs through all comports at once, a thread per port.
+        The images are prepared once and shared read-only, a failure of a
+        port does not stop the others. """
+    _import_serial_modules()
+    if "serial" not in sys.modules or "xmodem" not in sys.modules:
+        print("Need install pyserial and xmodem for python!")
+        return False
+    if len(set(comports)) < len(comports):
+        print("A port is given twice!")
+        return False
+    if not all(_check_comport_exist(comport) for comport in comports):
+        return False
+    prepared = [_prepare_station_job(job) for job in jobs]
+    if not prepared or None in prepared:
+        return False
+
+    if params.get('base'):
+        get_catalog()
+    output = _StationOutput(sys.stdout, comports)
+    results = {}
+    threads = []
+    for comport in comports:
+        capture = params.get('capture')
+        if capture is not None:
+            capture = '{}{}{}'.format(os.path.splitext(capture)[0],
+                                      _port_name(comport),
+                                      os.path.splitext(capture)[1])
+        port_params = dict(params, comport=comport, capture=capture)
+        thread = threading.Thread(target=_station_port, name=comport,
+                                  args=(port_params, prepared, results))
+        thread.daemon = True
+        threads.append(thread)
+
+    start = time.monotonic()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    try:
+        for thread in threads:
+            thread.start()
+        shown = {}
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(interval / len(threads))
+            for comport in comports:
+                status = output.status.get(comport)
+                if status is not None and status != shown.get(comport):
+                    shown[comport] = status
+                    print("{:<16} {}".format(comport, status))
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    for comport in comports:
+        ok, done, elapsed = results.get(comport, (False, 0, 0.0))
+        print("{:<16} {:<4} {:>7.1f}s {} of {} jobs  {}".format(
+            comport, 'OK' if ok else 'FAIL', elapsed, done, len(jobs),
+            '' if ok else output.status.get(comport, '')))
+    print("Burned {} of {} ports in {:.1f}s.".format(
+        sum(1 for result in results.values() if result[0]),
+        len(comports), time.monotonic() - start))
+    return all(results.get(comport, (False,))[0] for comport in comports)
 
 
+@telemetry.flow('all')
 def burn_all_firmwares(params):
     """ burn all firmwares by tftp """
     if not params['tftp'] and not params['xmodem'] and not params['telnet']:
         print("Currently only support tftp, xmodem and telnet!")
-        return
+        return False
 
-    if not _extract_firmwares(params['fwfile']):
+    bundle = _extract_firmwares(params['fwfile'])
+    if bundle is None:
         print("The {} is invaild!".format(params['fwfile']))
-        return
+        return False
     fwversion = re.search(
         r'([0-9].[0-9].[0-9]_[0-9]+)', params['fwfile'])
 
     fwversion = '' if fwversion is None else "_{}".format(fwversion.group(1))
 
-    os.rename('linux.bin', 'linux{}.bin'.format(fwversion))
     params['fwfile'] = 'linux{}.bin'.format(fwversion)
+    params['fwdata'] = bundle.section_data('linux')
     params['fwtype'] = 'kernel{}'.format(params['fwtype'][-2:])
     params['offset'] = params['linux_offset']
     if params['tftp']:
-        burn_by_tftp(params, in_flasher=False)
+        done = burn_by_tftp(params, in_flasher=False)
     elif params['xmodem']:
-        burn_by_xmodem(params, in_flasher=False)
+        done = burn_by_xmodem(params, in_flasher=False)
     elif params['telnet']:
-        burn_via_telnet(params, http_server=False)
+        http_server = ImageServer().start()
+        done = burn_via_telnet(params, http_server)
 
-    os.rename('rootfs.bin', 'rootfs{}.bin'.format(fwversion))
     params['fwfile'] = 'rootfs{}.bin'.format(fwversion)
+    params['fwdata'] = bundle.section_data('rootfs')
     params['fwtype'] = 'rootfs{}'.format(params['fwtype'][-2:])
     params['offset'] = params['rootfs_offset']
     if params['tftp']:
-        burn_by_tftp(params, in_flasher=True)
+        done = burn_by_tftp(params, in_flasher=True) and done
     elif params['xmodem']:
-        burn_by_xmodem(params, in_flasher=True)
+        done = burn_by_xmodem(params, in_flasher=True) and done
     elif params['telnet']:
-        burn_via_telnet(params, http_server=True)
+        done = burn_via_telnet(params, http_server) and done
 
-    params['fwfile'] = 'full{}.gbl'.format(fwversion)
+    params['fwfile'] = 'full_{}.gbl'.format(bundle.sections['full'].version)
+    params['fwdata'] = bundle.section_data('full')
     params['fwtype'] = 'silabs_ncp_bt'
     if params['telnet']:
-        burn_via_telnet(params, http_server=True, close_http_server=True)
+        done = burn_via_telnet(params, http_server) and done
+        http_server.stop()
+    params['fwdata'] = None
+    return done
 
 
 def burn_firmware(params):
@@ -950,22 +3346,22 @@ def burn_firmware(params):
     if not os.path.exists("{}/flasher.bin".format(base_path)):
         print("The flahser.bin is not exist!")
         return
-    if not os.path.exists(params['fwfile']):
+    if params.get('fwdata') is None and not os.path.exists(params['fwfile']):
         print("The {} is not exist!".format(params['fwfile']))
         return
 
     offset = firmware_info.get(params['fwtype'], '0')
 
     if 'all' in params['fwtype']:
-        with open(params['fwfile'], 'rb') as f_in:
-            data = f_in.read(16)
-        if data[:4] != b'MIOT':
+        if get_catalog().lookup(params['fwfile'])['kind'] != 'miot':
             print('{} is not vaild firmware file'.format(params['fwfile']))
             return
     elif offset == '0':
         print('Unknow firmware type!')
         return
 
+    if not params['telnet']:
+        _import_serial_modules()
     if "serial" not in sys.modules and (params['tftp'] or params['xmodem']):
         print("Need install pyserial for python!")
         return
@@ -989,6 +3385,10 @@ def burn_firmware(params):
         params['offset'] = offset
         burn_by_tftp(params)
         return
+    if params['xmodem'] and (params.get('blocks') or params.get('base')):
+        params['offset'] = offset
+        burn_by_xmodem_blocks(params)
+        return
     if params['xmodem']:
         params['offset'] = offset
         burn_by_xmodem(params)
@@ -999,10 +3399,28 @@ def burn_firmware(params):
               "connected to WiFI AP!")
         burn_via_telnet(params)
         return
-    # just for test
+    params['offset'] = offset
     burn_by_uart(params)
 
 
+def update_catalog(dirs):
+    """ update the catalog of firmware files """
+    start = time.monotonic()
+    dirs = [os.path.join(REPO_PATH, 'original'),
+            os.path.join(REPO_PATH, 'raw')] + dirs
+    catalog = get_catalog()
+    count = catalog.update([path for path in dirs if os.path.isdir(path)])
+    # the sums of the scanned files are not calculated again
+    get_sum_cache().seed(catalog.entries)
+    print("Scanned {} of {} files in {:.2f}s, saved to {}".format(
+        count, len(catalog.entries), time.monotonic() - start,
+        catalog.path))
+    for path, entry in sorted(catalog.entries.items()):
+        print("{:<10} {:<12} {:>9} {} {}".format(
+            entry['kind'], str(entry['version']), entry['size'],
+            hex(entry['sum']), path))
+
+
 def generate_telnet_password(did, mac, key):
     """ generate telnet password """
     print("did={}\nmac={}\nkey={}".format(did, mac, key))
@@ -1016,8 +3434,71 @@ def generate_telnet_password(did, mac, key):
     print("The password of telnet is {}".format(signature[-16:]))
 
 
-def backup_partition(params):
-    """ backup partition """
+BACKUP_CHUNK_SIZE = 0x10000
+NAND_SIZE = 0x8000000
+DB_LINE = re.compile(rb'\s*([0-9A-Fa-f]{8}):([0-9A-Fa-f\s]*)')
+
+
+def _partition_size(fwtype):
+    """ size of a partition up to the next one in firmware_info """
+    offsets = sorted(int(val, 0) for key, val in firmware_info.items()
+                     if key != 'silabs_ncp_bt')
+    offset = int(firmware_info[fwtype], 0)
+    return min([val for val in offsets if val > offset] + [NAND_SIZE]) - \
+        offset
+
+
+def parse_db_line(line):
+    """ (address, data) of a line of DB output, or None """
+    match = DB_LINE.match(line.split(b'|')[0])
+    if match is None:
+        return None
+    try:
+        data = bytes.fromhex(match.group(2).decode())
+    except ValueError:
+        return None
+    return int(match.group(1), 16), data
+
+
+def _backup_chunk(console, offset, ddr_base, size):
+    """ NANDR and DB one chunk, return its bytes or None """
+    prompt = b'<RealTek>'
+    command = 'NANDR {} {} {}\n'.format(hex(offset), ddr_base, hex(size))
+    clear_serial_buffer(console)
+    console.write(command.encode())
+    console.write(b'y\n')
+    # a prompt left over from an earlier line comes before the echo of
+    # the command and must not be taken as its answer
+    if console.expect(command.strip().encode(), 10) is None or \
+            not wait_for_realtek_cli(console):
+        return None
+    clear_serial_buffer(console)
+    command = 'DB {} {}\n'.format(ddr_base, size)
+    console.write(command.encode())
+    if console.expect(command.strip().encode(), 10) is None:
+        return None
+    address = int(ddr_base, 0)
+    buf = bytearray()
+    while True:
+        line = console.expect([b'\n', prompt])
+        if line is None:
+            return None
+        if line.endswith(prompt):
+            break
+        parsed = parse_db_line(line)
+        if parsed is None:
+            continue
+        if parsed[0] != address + len(buf):
+            print("Unexpected address {} in DB output!".format(
+                hex(parsed[0])))
+            return None
+        buf.extend(parsed[1])
+    return bytes(buf[:size]) if len(buf) >= size else None
+
+
+@telemetry.flow('backup')
+def backup_partition(params, retry=3):
+    """ backup partition in chunks, an interrupted backup is resumed """
     console = None
     firmware_backup_size = {'factory': 512,
                             # 'bootloader': 131072,
@@ -1028,48 +3509,91 @@ def backup_partition(params):
         data = input('The {} is exist, do you want to overwrite?(y/n)'.format(
             params['fwfile']))
         if data.upper() == 'N':
-            return
+            return False
 
-    if firmware_info.get(params['fwtype'], '0') == '0':
+    if firmware_info.get(params['fwtype'], '0') == '0' or \
+            params['fwtype'] == 'silabs_ncp_bt':
         print("Unknown firmware type.")
-        return
+        return False
+
+    fwsize = firmware_backup_size.get(params['fwtype'],
+                                      _partition_size(params['fwtype']))
+    offset = int(firmware_info[params['fwtype']], 0)
+    partfile = "{}.part".format(params['fwfile'])
 
     console = _bootrom_download_flasher(params, console, False)
 
     if console is None:
         print("Goto flasher failed, try again.")
-        return
+        return False
 
     console.write(b'\n\n')
 
-    wait_for_realtek_cli(console)
-    fwsize = firmware_backup_size.get(params['fwtype'], 0)
-    if fwsize == 0:
-        print('{} is not support yet!'.format(params['fwtype']))
-        return
+    if not wait_for_realtek_cli(console):
+        console.close()
+        return False
 
-    command = 'NANDR {} {} {}\n'.format(hex(int(firmware_info.get(
-        params['fwtype'], '0'), 0)), params['ddr_base'], hex(fwsize))
+    # the .part is resumed only for the same partition of the same unit
+    part = {'fwtype': params['fwtype'], 'offset': offset, 'size': fwsize,
+            'unit': _unit_id(console, params['ddr_base'])}
+    done = 0
+    if os.path.exists(partfile):
+        try:
+            with open("{}.json".format(partfile), 'r') as f_in:
+                saved = json.load(f_in)
+        except (OSError, ValueError):
+            saved = None
+        if saved != part or part['unit'] is None:
+            print("The {} is of another partition or unit, start "
+                  "over.".format(partfile))
+        else:
+            done = os.stat(partfile).st_size
+            done = done - done % BACKUP_CHUNK_SIZE
+            print("Resume from {} of {}.".format(hex(done), hex(fwsize)))
+    if not done:
+        try:
+            with open("{}.json".format(partfile), 'w') as f_out:
+                json.dump(part, f_out)
+        except OSError:
+            pass
 
-    console.write(command.encode())
-    console.write(b'y\n')
-    clear_serial_buffer(console)
-    wait_for_realtek_cli(console)
-    command = 'DB {} {}\n'.format(params['ddr_base'], fwsize)
-    console.write(command.encode())
-    raw = ''
-    data = str(console.read_until(), encoding="utf-8")
-    while "<RealTek>" not in data:
-        raw = "{}{}".format(raw, data)
-        data = str(console.read_until(), encoding="utf-8")
-    with open(params['fwfile'], 'wb') as f_out:
-        for i in raw.splitlines():
-            if 'A100' in i:
-                data = i.split(': ')[1].split(
-                    '  |')[0].rstrip().replace('  ', ' ')
-                for j in data.split(' '):
-                    f_out.write(int(j, 16).to_bytes(
-                        1, byteorder='big', signed=False))
+    with open(partfile, 'r+b' if done else 'wb') as f_out:
+        f_out.truncate(done)
+        f_out.seek(done)
+        while done < fwsize:
+            size = min(BACKUP_CHUNK_SIZE, fwsize - done)
+            phase = telemetry.phase('nandr', size)
+            for _ in range(retry):
+                data = _backup_chunk(console, offset + done,
+                                     params['ddr_base'], size)
+                if data is not None:
+                    phase.done()
+                    break
+            else:
+                print("Backup failed at {}, run again to resume.".format(
+                    hex(done)))
+                console.close()
+                return False
+            f_out.write(data)
+            f_out.flush()
+            done = done + size
+            sys.stdout.write("Backup progress: %d%%   \r" % (
+                done * 100 / fwsize))
+            sys.stdout.flush()
+    console.close()
+
+    sha256 = hashlib.sha256()
+    with open(partfile, 'rb') as f_in:
+        for data in iter(lambda: f_in.read(SUM_BLOCK_SIZE), b''):
+            sha256.update(data)
+    os.replace(partfile, params['fwfile'])
+    if os.path.exists("{}.json".format(partfile)):
+        os.remove("{}.json".format(partfile))
+    with open("{}.sha256".format(params['fwfile']), 'w') as f_out:
+        f_out.write("{}  {}\n".format(sha256.hexdigest(),
+                                       os.path.basename(params['fwfile'])))
+    print("Backup {} ({} bytes) Done!".format(params['fwfile'], fwsize))
+    return True
 
 
 def main():
@@ -1107,7 +3631,8 @@ def main():
     group.add_argument('-r', '--ipaddr', dest='ipaddr',
                        help='The gateway 3 ip address')
     group.add_argument('-i', '--boot_info', dest='info_file',
-                       help='Calc boot_info')
+                       help='Calc boot_info of a yaml, or show a '
+                       'boot_info.bin backup')
     group.add_argument('-l', '--cmdline', dest='cmdline',
                        help='Convert cmdline string')
     group.add_argument('-s', '--sum', action='store_true',
@@ -1117,18 +3642,92 @@ def main():
     group.add_argument('-g', '--generate', action='store_true',
                        help='Generate firmware file for fw_update')
     group.add_argument('-a', '--backup', action='store_true',
-                       help='Backup fatory/boot_info/homekit partition')
+                       help='Backup a partition, e.g. '
+                       'fatory/boot_info/homekit/linux_0/rootfs_1')
     group.add_argument('-k', '--key', dest='key',
                        help='Xiaomi key')
     group.add_argument('-m', '--mac', dest='mac',
                        help='Device Mac Address')
     group.add_argument('-e', '--did', dest='did',
                        help='Device ID')
+    group.add_argument('-v', '--fwversion', dest='fwversion',
+                       help='Find the firmware file of this version '
+                       'in the catalog, e.g. 1.5.0_0102')
+    group.add_argument('--fleet', nargs='+', metavar='IP',
+                       help='Burn firmware to many gateways by telnet, '
+                       'ip or ip:port')
+    group.add_argument('--concurrency', type=int, default=8,
+                       help='Gateways updated at the same time by --fleet')
+    group.add_argument('--station', nargs='+', metavar='PORT',
+                       help='Burn by xmodem through all the serial ports '
+                       'at once')
+    group.add_argument('--job', metavar='YAML',
+                       help='Jobs of --station burned in order, a list of '
+                       'fwtype with fwfile or fwversion')
+    group.add_argument('--blocks', action='store_true',
+                       help='Burn by xmodem in 128KB blocks which can '
+                       'be resumed')
+    group.add_argument('--base', metavar='FILE|VERSION',
+                       help='Only burn the 128KB blocks which differ from '
+                       'this backup/firmware or catalog version of the slot')
+    group.add_argument('--detect-baudrate', action='store_true',
+                       help='Detect the baud rate of the flasher if it '
+                       'does not answer at the expected one')
+    group.add_argument('--gzip', action='store_true',
+                       help='Serve the image gzip compressed to telnet '
+                       'burns, the gateway gunzips it')
+    group.add_argument('--verify', action='store_true',
+                       help='Compare the md5 of the flashed slot with '
+                       'the image after a telnet burn')
+    group.add_argument('--info-diff', nargs=2, metavar='BIN',
+                       help='Show the differences of two boot_info.bin')
+    group.add_argument('--info-batch', nargs=2, metavar=('SRC', 'OUTDIR'),
+                       help='Generate boot_info commands of each yaml in '
+                       'the directory SRC or each row of the CSV file SRC')
+    group.add_argument('--capture', nargs='?', const='', metavar='FILE',
+                       help='Append the serial output of the session to '
+                       'FILE, default is a new file in captures/ of the '
+                       'cache')
+    group.add_argument('--prepare', action='store_true',
+                       help='Store the sums, fw_update image and gzip '
+                       '(with --gzip) of -f in the artifact cache')
+    group.add_argument('--cache-size', type=int, metavar='MB',
+                       help='Size limit of the artifact cache, default '
+                       '{} MB'.format(ARTIFACT_CACHE_SIZE))
+    group.add_argument('--events', metavar='FILE',
+                       help='Append JSON-lines timing events of the '
+                       'burn/backup phases to FILE')
+    group.add_argument('--prom', metavar='FILE',
+                       help='Write the phase timings as a Prometheus '
+                       'textfile')
+    group.add_argument('--catalog', nargs='*', metavar='DIR',
+                       help='Update the catalog of original/, raw/ '
+                       'and DIR')
     args = parser.parse_args()
 
     if sys.version_info < (3, 6):
         print("Please install Python3.7 and above!")
         return
+    telemetry.path = args.events
+    if args.cache_size is not None:
+        get_artifact_cache().max_size = args.cache_size << 20
+
+    if args.catalog is not None:
+        update_catalog(args.catalog)
+        return
+
+    fwdata = None
+    if args.fwversion and args.fwtype and not args.fwfile:
+        args.fwfile, section = get_catalog().find(
+            args.fwversion, args.fwtype)
+        if args.fwfile is None:
+            print("The {} of {} is not in the catalog!".format(
+                args.fwtype, args.fwversion))
+            return
+        print("Found {} {}".format(args.fwfile, section or ''))
+        if section is not None:
+            fwdata = _extract_firmwares(args.fwfile).section_data(section)
+            args.fwfile = '{}_{}.bin'.format(section, args.fwversion)
 
     if args.key and args.mac and args.did:
         generate_telnet_password(args.did, args.mac, args.key)
@@ -1139,11 +3738,23 @@ def main():
         return
 
     if args.sum and args.fwfile:
-        calc_sum_of_firmware(args.fwfile, log=True)
+        calc_sum_of_firmware(args.fwfile, log=True, data=fwdata)
         return
 
     if args.checksum and args.fwfile:
-        calc_checksum_of_firmware(args.fwfile, log=True)
+        calc_checksum_of_firmware(args.fwfile, log=True, data=fwdata)
+        return
+
+    if args.info_batch:
+        generate_boot_info_batch(*args.info_batch)
+        return
+
+    if args.info_diff:
+        show_boot_info(*args.info_diff)
+        return
+
+    if args.info_file and args.info_file.endswith('.bin'):
+        show_boot_info(args.info_file)
         return
 
     if args.info_file:
@@ -1156,6 +3767,10 @@ def main():
 
     baudrate = args.baudrate if args.baudrate else 38400
 
+    capture = args.capture
+    if capture == '':
+        capture = os.path.join(CACHE_DIR, 'captures', '{}.log'.format(
+            time.strftime('%Y%m%d-%H%M%S')))
     params = {'ddr_base': '0xa1000000',
               'xmodem': args.xmodem,
               'tftp': args.tftp,
@@ -1164,17 +3779,49 @@ def main():
               'baudrate': baudrate,
               'fwtype': args.fwtype,
               'fwfile': args.fwfile,
+              'fwdata': fwdata,
+              'detect_baudrate': args.detect_baudrate,
+              'blocks': args.blocks,
+              'base': args.base,
+              'verify': args.verify,
+              'gzip': args.gzip,
+              'capture': capture,
               'debug': args.debug}
+    if args.prepare and args.fwfile and args.fwtype:
+        prepare_artifacts(params)
+        return
+
     if args.backup and args.fwfile and args.comport:
         backup_partition(params)
+        report_telemetry(args.prom)
+        return
+
+    if args.station and (args.job or args.fwtype):
+        if args.tftp or args.telnet:
+            print("Station mode only support xmodem!")
+            return
+        jobs = [{'fwtype': args.fwtype, 'fwversion': args.fwversion}
+                if args.fwversion else
+                {'fwtype': args.fwtype, 'fwfile': args.fwfile}]
+        if args.job:
+            jobs = load_station_jobs(args.job)
+        if jobs:
+            burn_station(params, args.station, jobs)
+            report_telemetry(args.prom)
+        return
+
+    if args.fleet and args.fwfile and args.fwtype:
+        burn_fleet(params, args.fleet, args.concurrency)
         return
 
     if args.telnet and args.fwfile and args.fwtype and args.ipaddr:
         params['ipaddr'] = args.ipaddr
         burn_firmware(params)
+        report_telemetry(args.prom)
         return
 
     if args.fwfile and args.fwtype and args.comport:
+        _import_serial_modules()
         if "serial" not in sys.modules or "xmodem" not in sys.modules:
             print("Notice: serial or xmodem module is not installed!")
             print("        pip install -r requirements.txt")
@@ -1182,6 +3829,7 @@ def main():
             print("Please choose one transmit type!")
             return
         burn_firmware(params)
+        report_telemetry(args.prom)
         return
 
     print("Invaild arguments, Use -h or --help to known how to use.")